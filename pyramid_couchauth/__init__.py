@@ -12,30 +12,329 @@ def configure(config, database):
     Load Pyramid with the couchauth auth/auth policies.
 
     Settings:
+      couchauth.identifier -- The identifier to use: authtkt for cookies or
+        bearer for API key bearer tokens. Defaults to authtkt.
       couchauth.secret -- The shared secret used by the AuthTkt identifier.
+      couchauth.token_cache_size -- The number of bearer tokens to cache.
+        Defaults to 10000.
+      couchauth.token_cache_ttl -- The number of seconds a cached bearer token
+        remains valid. Defaults to 300.
+      couchauth.token_follow_changes -- Follow the _changes feed of the token
+        hashes view so tokens revoked in the database are evicted from the
+        cache of every process immediately. Without it a revoked token is
+        accepted until its cached entry expires. Defaults to true.
+      couchauth.cache_size -- The number of user and grant lookups to cache.
+        Defaults to 0 which disables caching.
+      couchauth.cache_ttl -- The number of seconds a cached lookup remains
+        valid. Defaults to 60.
+      couchauth.refresh_ahead -- Reload frequently used lookups in the
+        background before they expire. Defaults to false.
+      couchauth.user_filter -- Reject unknown usernames using an in memory
+        Bloom filter of all usernames. Defaults to false.
+      couchauth.user_filter_error_rate -- The false positive rate of the
+        username filter. Defaults to 0.01.
+      couchauth.user_filter_interval -- The number of seconds between periodic
+        username filter rebuilds. Defaults to 300.
+      couchauth.user_filter_follow_changes -- Rebuild the username filter as
+        soon as the _changes feed reports a change to the user names view.
+        Defaults to true.
+      couchauth.hierarchical -- Treat permissions as dotted names which may be
+        granted with wildcards. Compiled grants are cached separately from
+        lookups, sized by couchauth.cache_size and couchauth.cache_ttl when
+        set. Defaults to false.
+      couchauth.decision_cache_size -- The number of permission check results
+        to cache. Defaults to 0 which disables the decision cache.
+      couchauth.decision_cache_ttl -- The number of seconds a cached decision
+        remains valid. Defaults to 60.
+      couchauth.audit -- Write an audit document to the database for every
+        permission check, remember and forget. Records still queued at
+        interpreter exit are written then. Defaults to false.
+      couchauth.audit_queue_size -- The maximum number of audit records
+        waiting to be written. Defaults to 10000.
+      couchauth.audit_batch_size -- The maximum number of audit records per
+        write. Defaults to 100.
+      couchauth.audit_flush_interval -- The maximum number of seconds an audit
+        record waits to be written. Defaults to 1.
+      couchauth.audit_sample_rate -- The fraction of audit records kept once
+        the queue is 80% full. Defaults to 1.
+      couchauth.security_policy -- Register a single Pyramid 2.x security
+        policy which resolves each request's identity once instead of the
+        legacy authentication and authorization policies. Requires Pyramid
+        2.0 or later. Defaults to false.
+      couchauth.prefetch_permissions -- When using the security policy, load
+        all of the user's permissions while resolving the identity. Defaults
+        to false.
+      couchauth.timing -- Add a Server-Timing header to each response with the
+        time spent in each auth step. Defaults to false.
+      couchauth.slow_threshold -- When timing, log requests which spend more
+        than this many milliseconds in auth steps.
 
     :param config: The Pyramid config object.
     :param database: The couchdbkit database containing the authentication
         views.
     """
-    settings = config.get_settings()
+    get_setting = _setting_getter(config)
+    identifier = _identifier(get_setting, database)
+    audit = _audit_log(get_setting, database)
+    authentication, authorization = _policies(get_setting, database,
+        identifier, audit)
+
+    def security_policy(prefetch_permissions):
+        from pyramid_couchauth.security import CouchSecurityPolicy
+        return CouchSecurityPolicy(authentication, authorization,
+            prefetch_permissions=prefetch_permissions)
+
+    _register(config, get_setting, authentication, authorization,
+        security_policy)
+    return config
+
+
+def configure_tenants(config, server, resolver):
+    """
+    Load Pyramid with multi-tenant couchauth auth/auth policies. Each tenant
+    has its own database on the given server and all tenants share the
+    server's connection pool. Users are identified with an AuthTkt cookie
+    which is bound to the tenant it was issued for, or with bearer tokens
+    looked up in the tenant's database.
+
+    Accepts the settings of configure, which apply to each tenant. Caches
+    are created per tenant and evicted with it. Audit records of all tenants
+    are written to one database with a tenant field. The
+    couchauth.refresh_ahead and couchauth.user_filter settings are refused
+    because they would start background threads for every tenant. For the
+    same reason bearer tokens do not follow the _changes feed in tenant mode,
+    so a revoked token is accepted until its cached entry expires. The
+    couchauth.token_cache_ttl setting defaults to 30 seconds here to bound
+    that window.
+
+    Additional settings:
+      couchauth.database_format -- The format used to build a database name
+        from a tenant name. Defaults to %s.
+      couchauth.tenants -- A whitespace separated list of allowed tenant
+        names. By default any tenant name with a database is allowed.
+      couchauth.tenant_pattern -- A regular expression tenant names must
+        match. Defaults to ^[a-z0-9][a-z0-9_-]*$ which refuses CouchDB system
+        databases.
+      couchauth.max_tenants -- The maximum number of tenants to hold policies
+        for. Defaults to 1000.
+      couchauth.tenant_idle_ttl -- The number of seconds an unused tenant is
+        kept. Defaults to 600.
+      couchauth.audit_database -- The database audit records are written to.
+        Defaults to couchauth_audit.
+
+    :param config: The Pyramid config object.
+    :param server: The couchdbkit server holding the tenant databases.
+    :param resolver: A callable returning the tenant name of a request or
+        None. See pyramid_couchauth.tenancy.
+    """
+    from pyramid.exceptions import ConfigurationError
+    from pyramid.settings import asbool, aslist
+    from pyramid_couchauth.tenancy import (TENANT_PATTERN,
+        ServerDatabaseFactory, TenantAuthenticationPolicy,
+        TenantAuthorizationPolicy, TenantIdentifier, TenantRegistry)
+
+    get_setting = _setting_getter(config)
+    for name in ('couchauth.refresh_ahead', 'couchauth.user_filter'):
+        if asbool(get_setting(name, False)):
+            raise ConfigurationError('%s is not supported with tenants' % name)
+
+    shared_identifier = None
+    if get_setting('couchauth.identifier', 'authtkt') != 'bearer':
+        shared_identifier = _identifier(get_setting, None)
+    audit = None
+    if asbool(get_setting('couchauth.audit', False)):
+        audit = _audit_log(get_setting, server.get_or_create_db(
+            get_setting('couchauth.audit_database', 'couchauth_audit')))
+
+    def policy_factory(tenant, database):
+        if shared_identifier is None:
+            identifier = _identifier(get_setting, database, tenant=True)
+        else:
+            identifier = TenantIdentifier(shared_identifier, tenant)
+        tenant_audit = None
+        if audit is not None:
+            tenant_audit = audit.bind(tenant=tenant)
+        return _policies(get_setting, database, identifier, tenant_audit)
+
+    allowed = get_setting('couchauth.tenants')
+    if allowed is not None:
+        allowed = set(aslist(allowed))
+    registry = TenantRegistry(resolver,
+        ServerDatabaseFactory(server,
+            get_setting('couchauth.database_format', '%s')),
+        policy_factory,
+        max_tenants=int(get_setting('couchauth.max_tenants', 1000)),
+        idle_ttl=float(get_setting('couchauth.tenant_idle_ttl', 600)),
+        allowed=allowed,
+        pattern=get_setting('couchauth.tenant_pattern', TENANT_PATTERN))
+
+    def security_policy(prefetch_permissions):
+        from pyramid_couchauth.security import TenantSecurityPolicy
+        return TenantSecurityPolicy(registry,
+            prefetch_permissions=prefetch_permissions)
+
+    _register(config, get_setting, TenantAuthenticationPolicy(registry),
+        TenantAuthorizationPolicy(registry), security_policy)
+    return config
+
+
+def _setting_getter(config):
+    """
+    Create a lookup function for the settings of a config.
+
+    :param config: The Pyramid config object.
+    :return: A callable taking a setting name and a default value.
+    """
+    settings = config.get_settings() or {}
 
     def get_setting(name, default=None):
         if name in settings:
             return settings[name]
         else:
             return default
+    return get_setting
+
 
-    from pyramid_couchauth.identification import AuthTktIdentifier
+def _identifier(get_setting, database, tenant=False):
+    """
+    Create the identifier selected by the couchauth.identifier setting.
+
+    :param get_setting: The settings lookup function.
+    :param database: The database holding the token hashes view.
+    :param tenant: Create the identifier of a tenant, which starts no
+        background threads.
+    :return: The identifier.
+    """
+    from pyramid.settings import asbool
+    from pyramid_couchauth.cache import TTLCache
+    from pyramid_couchauth.identification import (AuthTktIdentifier,
+        BearerTokenIdentifier)
+
+    if get_setting('couchauth.identifier', 'authtkt') == 'bearer':
+        token_cache = TTLCache(
+            int(get_setting('couchauth.token_cache_size', 10000)),
+            float(get_setting('couchauth.token_cache_ttl',
+                30 if tenant else 300)))
+        identifier = BearerTokenIdentifier(database, cache=token_cache)
+        if not tenant and asbool(get_setting(
+                'couchauth.token_follow_changes', True)):
+            identifier.start()
+        return identifier
+    return AuthTktIdentifier(get_setting('couchauth.secret', 'secret'))
+
+
+def _audit_log(get_setting, database):
+    """
+    Create and start the audit log if the couchauth.audit setting is on. The
+    log is stopped at interpreter exit so queued records are written rather
+    than lost with the daemon writer thread.
+
+    :param get_setting: The settings lookup function.
+    :param database: The database audit records are written to.
+    :return: The AuditLog or None.
+    """
+    import atexit
+    from pyramid.settings import asbool
+    from pyramid_couchauth.audit import AuditLog
+
+    if not asbool(get_setting('couchauth.audit', False)):
+        return None
+    audit = AuditLog(database,
+        max_queue=int(get_setting('couchauth.audit_queue_size', 10000)),
+        batch_size=int(get_setting('couchauth.audit_batch_size', 100)),
+        flush_interval=float(get_setting('couchauth.audit_flush_interval',
+            1)),
+        sample_rate=float(get_setting('couchauth.audit_sample_rate', 1)))
+    audit.start()
+    atexit.register(audit.stop)
+    return audit
+
+
+def _policies(get_setting, database, identifier, audit):
+    """
+    Create the authentication and authorization policies of a database along
+    with the caches and username filter selected by the settings.
+
+    :param get_setting: The settings lookup function.
+    :param database: The database containing the authentication views.
+    :param identifier: The identifier used by the authentication policy.
+    :param audit: The AuditLog shared by both policies or None.
+    :return: A tuple of the authentication and authorization policies.
+    """
+    from pyramid.settings import asbool
+    from pyramid_couchauth.bloom import UserNameFilter
+    from pyramid_couchauth.cache import RefreshAheadCache, TTLCache
     from pyramid_couchauth.policies import (CouchAuthenticationPolicy,
         CouchAuthorizationPolicy)
 
-    secret = get_setting('couchauth.secret', 'secret')
-    identifier = AuthTktIdentifier(secret)
-    authentication = CouchAuthenticationPolicy(database, identifier)
-    authorization = CouchAuthorizationPolicy(database)
+    cache = None
+    cache_size = int(get_setting('couchauth.cache_size', 0))
+    if cache_size > 0:
+        cache_ttl = float(get_setting('couchauth.cache_ttl', 60))
+        if asbool(get_setting('couchauth.refresh_ahead', False)):
+            cache = RefreshAheadCache(cache_size, cache_ttl,
+                refresh_window=cache_ttl / 6)
+            cache.start()
+        else:
+            cache = TTLCache(cache_size, cache_ttl)
+
+    user_filter = None
+    if asbool(get_setting('couchauth.user_filter', False)):
+        user_filter = UserNameFilter(database,
+            error_rate=float(get_setting('couchauth.user_filter_error_rate',
+                0.01)),
+            interval=float(get_setting('couchauth.user_filter_interval', 300)),
+            follow_changes=asbool(get_setting(
+                'couchauth.user_filter_follow_changes', True)))
+        user_filter.start()
 
-    config.set_authentication_policy(authentication)
-    config.set_authorization_policy(authorization)
-    return config
+    decision_cache = None
+    decision_cache_size = int(get_setting('couchauth.decision_cache_size', 0))
+    if decision_cache_size > 0:
+        decision_cache = TTLCache(decision_cache_size,
+            float(get_setting('couchauth.decision_cache_ttl', 60)))
+
+    hierarchical = asbool(get_setting('couchauth.hierarchical', False))
+    trie_cache = None
+    if hierarchical and cache is not None:
+        trie_cache = TTLCache(cache_size, cache_ttl)
+
+    authentication = CouchAuthenticationPolicy(database, identifier,
+        cache=cache, user_filter=user_filter, audit=audit)
+    authorization = CouchAuthorizationPolicy(database,
+        hierarchical=hierarchical, cache=cache, audit=audit,
+        decision_cache=decision_cache, trie_cache=trie_cache,
+        authentication=authentication)
+    return authentication, authorization
+
+
+def _register(config, get_setting, authentication, authorization,
+        security_policy):
+    """
+    Register either the security policy or the legacy policies, and the
+    timing tween if enabled.
+
+    :param config: The Pyramid config object.
+    :param get_setting: The settings lookup function.
+    :param authentication: The legacy authentication policy.
+    :param authorization: The legacy authorization policy.
+    :param security_policy: A callable taking the prefetch_permissions flag
+        which creates the security policy.
+    """
+    from pyramid.exceptions import ConfigurationError
+    from pyramid.settings import asbool
+
+    if asbool(get_setting('couchauth.security_policy', False)):
+        prefetch = asbool(get_setting('couchauth.prefetch_permissions', False))
+        try:
+            policy = security_policy(prefetch)
+        except ImportError:
+            raise ConfigurationError(
+                'couchauth.security_policy requires Pyramid 2.0 or later')
+        config.set_security_policy(policy)
+    else:
+        config.set_authentication_policy(authentication)
+        config.set_authorization_policy(authorization)
 
+    if asbool(get_setting('couchauth.timing', False)):
+        config.add_tween('pyramid_couchauth.tweens.timing_tween_factory')
@@ -0,0 +1,223 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Asynchronous audit logging of auth/auth decisions to CouchDB.
+"""
+
+import logging
+import random
+import threading
+import time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # pragma: no cover
+    from Queue import Queue, Empty, Full
+
+log = logging.getLogger(__name__)
+
+
+class AuditLog:
+
+    """
+    Records audit documents on a bounded queue and writes them to CouchDB in
+    batches from a background thread. A batch is written once it holds
+    batch_size records or flush_interval seconds after its first record,
+    whichever comes first.
+
+    Recording never blocks. Once the queue is more than sample_threshold full
+    records are kept with probability sample_rate, and records which do not
+    fit in the queue are dropped. Both losses are counted in the sampled and
+    dropped attributes. Records which fail to be written are counted in
+    failed.
+    """
+
+    def __init__(self, database, max_queue=10000, batch_size=100,
+            flush_interval=1, sample_rate=1, sample_threshold=0.8,
+            clock=time.time):
+        """
+        Create a new audit log.
+
+        :param database: The database to write audit documents to.
+        :param max_queue: The maximum number of records waiting to be written.
+        :param batch_size: The maximum number of records per write.
+        :param flush_interval: The maximum number of seconds a record waits
+            before its batch is written.
+        :param sample_rate: The fraction of records kept while the queue is
+            above sample_threshold.
+        :param sample_threshold: The fraction of max_queue at which sampling
+            starts.
+        :param clock: A callable returning the current time in seconds.
+        """
+        self.database = database
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.sample_threshold = sample_threshold
+        self.clock = clock
+        self.queue = Queue(max_queue)
+        self.lock = threading.Lock()
+        self.sampled = 0
+        self.dropped = 0
+        self.failed = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def _count(self, name, amount=1):
+        """Increment a loss counter."""
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record(self, event, **fields):
+        """
+        Queue an audit record without blocking.
+
+        :param event: The name of the audited event.
+        :param fields: Additional fields to store in the audit document.
+        :return: True if the record was queued, False if it was sampled out
+            or dropped.
+        """
+        if (self.sample_rate < 1 and
+                self.queue.qsize() >= self.max_queue * self.sample_threshold and
+                random.random() >= self.sample_rate):
+            self._count('sampled')
+            return False
+        doc = {'type': 'audit', 'event': event, 'time': self.clock()}
+        doc.update(fields)
+        try:
+            self.queue.put_nowait(doc)
+        except Full:
+            self._count('dropped')
+            return False
+        return True
+
+    def bind(self, **fields):
+        """
+        Return a view of the log which adds fixed fields to every record.
+
+        :param fields: The fields to add, such as the tenant name.
+        :return: A BoundAuditLog.
+        """
+        return BoundAuditLog(self, **fields)
+
+    def _write(self, docs):
+        """
+        Write a batch of audit documents with _bulk_docs.
+
+        :param docs: The documents to write.
+        """
+        try:
+            self.database.bulk_save(docs)
+        except Exception:
+            log.exception('failed to write %i audit records', len(docs))
+            self._count('failed', len(docs))
+
+    def flush(self):
+        """
+        Write all queued records in batches.
+
+        :return: The number of records written.
+        """
+        written = 0
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    doc = self.queue.get_nowait()
+                except Empty:
+                    break
+                if doc is not None:
+                    batch.append(doc)
+            if not batch:
+                return written
+            self._write(batch)
+            written += len(batch)
+
+    def _collect(self):
+        """
+        Wait for a batch of records.
+
+        :return: A list of up to batch_size records. Empty if none arrived
+            before the flush interval elapsed.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                doc = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if doc is None:
+                break
+            batch.append(doc)
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+        return batch
+
+    def _run(self):
+        """Write batches until stopped."""
+        while not self.stopping.is_set():
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+
+    def start(self):
+        """Start the writer thread."""
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread and write any remaining records. The writer is
+        woken so stopping does not wait for the flush interval.
+        """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.flush()
+
+
+class BoundAuditLog:
+
+    """
+    Records to an AuditLog with fixed fields added to every record. Used to
+    share one log between tenants.
+    """
+
+    def __init__(self, audit, **fields):
+        """
+        Create a new bound audit log.
+
+        :param audit: The AuditLog to record to.
+        :param fields: The fields to add to every record.
+        """
+        self.audit = audit
+        self.fields = fields
+
+    def record(self, event, **fields):
+        """
+        Queue an audit record with the bound fields without blocking.
+
+        :param event: The name of the audited event.
+        :param fields: Additional fields to store in the audit document.
+        :return: True if the record was queued, False otherwise.
+        """
+        doc = dict(self.fields)
+        doc.update(fields)
+        return self.audit.record(event, **doc)
@@ -0,0 +1,227 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Bloom filters for rejecting unknown users without querying CouchDB.
+"""
+
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+import timeit
+from pyramid_couchauth.changes import ChangesFollower
+
+log = logging.getLogger(__name__)
+
+
+class BloomFilter:
+
+    """
+    A bit array backed Bloom filter. Membership tests never give false
+    negatives and give false positives at roughly the configured rate as long
+    as no more than capacity items are added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Create an empty filter.
+
+        :param capacity: The number of items the filter is sized for.
+        :param error_rate: The false positive rate at capacity.
+        """
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1,
+            int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, item):
+        """
+        Generate the bit indexes for an item using double hashing.
+
+        :param item: The item to hash.
+        """
+        if not isinstance(item, bytes):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(item).digest())
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        """
+        Add an item to the filter.
+
+        :param item: The item to add.
+        """
+        for index in self._indexes(item):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        """Return False if the item was definitely never added."""
+        for index in self._indexes(item):
+            if not self.bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    @property
+    def size_bytes(self):
+        """The memory used by the bit array in bytes."""
+        return len(self.bits)
+
+
+class UserNameFilter:
+
+    """
+    Keeps a BloomFilter of every username in the user names view. A username
+    missing from the filter definitely does not exist and may be rejected
+    without a query.
+
+    The filter is built from the view on start, or on first use if it is not
+    started. While started, a background thread follows the database's
+    _changes feed, filtered to documents in the user names view, and rebuilds
+    the filter as soon as users change. It also rebuilds every interval
+    seconds as a safety net. Users added in this process, such as those
+    passed to CouchAuthenticationPolicy.remember, are added immediately and
+    survive a rebuild which is in progress.
+    """
+
+    def __init__(self, database, user_names_view='pyramid/user_names',
+            error_rate=0.01, interval=300, headroom=1.25,
+            follow_changes=True, changes_timeout=10):
+        """
+        Create a new username filter.
+
+        :param database: The database containing the user names view.
+        :param user_names_view: A view which maps the username as the key.
+        :param error_rate: The false positive rate of the filter.
+        :param interval: The number of seconds between periodic rebuilds.
+        :param headroom: The filter is sized for this many times the current
+            number of users so users added between rebuilds keep the error
+            rate in check.
+        :param follow_changes: Rebuild the filter when the _changes feed
+            reports a change to the user names view.
+        :param changes_timeout: The number of seconds each long poll of the
+            _changes feed waits for a change.
+        """
+        self.database = database
+        self.user_names_view = user_names_view
+        self.error_rate = error_rate
+        self.interval = interval
+        self.headroom = headroom
+        self.follow_changes = follow_changes
+        self.changes = ChangesFollower(database, user_names_view,
+            lambda ids: self.rebuild(), changes_timeout)
+        self.filter = None
+        self.added = None
+        self.build_time = None
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def rebuild(self):
+        """
+        Rebuild the filter from the user names view. The new filter replaces
+        the old one once it is complete. Users added while the view is read
+        are carried over to the new filter.
+        """
+        with self.rebuild_lock:
+            start = timeit.default_timer()
+            with self.lock:
+                self.added = []
+            try:
+                names = [row['key'] for row in
+                    self.database.view(self.user_names_view)]
+                bloom = BloomFilter(int(len(names) * self.headroom),
+                    self.error_rate)
+                for name in names:
+                    bloom.add(name)
+            except Exception:
+                with self.lock:
+                    self.added = None
+                raise
+            with self.lock:
+                for name in self.added:
+                    bloom.add(name)
+                self.added = None
+                self.filter = bloom
+            self.build_time = timeit.default_timer() - start
+        log.info('built username filter: %i users, %i bytes, %.3fs',
+            bloom.count, bloom.size_bytes, self.build_time)
+
+    def add(self, username):
+        """
+        Add a newly created user to the filter.
+
+        :param username: The username to add.
+        """
+        with self.lock:
+            if self.filter is not None:
+                self.filter.add(username)
+            if self.added is not None:
+                self.added.append(username)
+
+    def might_exist(self, username):
+        """
+        Check if a user might exist.
+
+        :param username: The username to check.
+        :return: False if the user definitely does not exist, True otherwise.
+        """
+        if self.filter is None:
+            with self.rebuild_lock:
+                build = self.filter is None
+            if build:
+                self.rebuild()
+        return username in self.filter
+
+    @property
+    def size_bytes(self):
+        """The memory used by the filter in bytes."""
+        return self.filter.size_bytes if self.filter is not None else 0
+
+    def _run(self):
+        """Keep the filter current until stopped."""
+        deadline = time.time() + self.interval
+        while not self.stopping.is_set():
+            try:
+                if self.follow_changes:
+                    if self.changes.poll():
+                        deadline = time.time() + self.interval
+                else:
+                    self.stopping.wait(max(0, deadline - time.time()))
+                if not self.stopping.is_set() and time.time() >= deadline:
+                    self.rebuild()
+                    deadline = time.time() + self.interval
+            except Exception:
+                log.exception('failed to update username filter')
+                self.stopping.wait(self.changes.timeout)
+
+    def start(self):
+        """Build the filter and start the update thread."""
+        if self.thread is not None:
+            return
+        if self.follow_changes:
+            self.changes.reset()
+        self.rebuild()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the update thread and wait for it to exit."""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
@@ -0,0 +1,383 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Caches for data retrieved from CouchDB views.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from queue import Queue, Full
+except ImportError:  # pragma: no cover
+    from Queue import Queue, Full
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache:
+
+    """
+    A thread safe, size bounded cache. Entries expire a fixed number of
+    seconds after they are stored, or after they were last used if the cache
+    is sliding. When the cache is full the least recently used entry is
+    evicted.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.time, sliding=False):
+        """
+        Create a new cache.
+
+        :param max_size: The maximum number of entries to hold.
+        :param ttl: The number of seconds an entry remains valid.
+        :param clock: A callable returning the current time in seconds.
+        :param sliding: Restart the ttl of an entry each time it is retrieved.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.sliding = sliding
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits."""
+        while len(self.entries) > self.max_size:
+            key, _ = self.entries.popitem(last=False)
+            self._evicted(key)
+
+    def _evicted(self, key):
+        """
+        Called when a key is removed from the cache. Subclasses use this to
+        drop any bookkeeping kept for the key.
+
+        :param key: The removed key.
+        """
+
+    def get(self, key, default=None):
+        """
+        Retrieve a value from the cache.
+
+        :param key: The key to look up.
+        :param default: The value to return on a miss.
+        :return: The cached value or default if the key is absent or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            now = self.clock()
+            if entry[1] <= now:
+                del self.entries[key]
+                self._evicted(key)
+                return default
+            if self.sliding:
+                entry = (entry[0], now + self.ttl)
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value in the cache.
+
+        :param key: The key to store the value under.
+        :param value: The value to store.
+        :param ttl: The number of seconds the value remains valid. Defaults to
+            the ttl of the cache.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, self.clock() + ttl)
+            self._evict()
+
+    def fetch(self, key, loader):
+        """
+        Retrieve a value from the cache, loading and storing it on a miss.
+
+        :param key: The key to look up.
+        :param loader: A callable taking no arguments which returns the value
+            for the key.
+        :return: The cached or loaded value.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Remove a key from the cache.
+
+        :param key: The key to remove.
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._evicted(key)
+
+    def invalidate_matching(self, predicate):
+        """
+        Remove every key for which a predicate is true.
+
+        :param predicate: A callable taking a key and returning True if it
+            should be removed.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+                self._evicted(key)
+
+    def invalidate_values(self, predicate):
+        """
+        Remove every entry whose value a predicate is true for.
+
+        :param predicate: A callable taking a value and returning True if its
+            entry should be removed.
+        """
+        with self.lock:
+            for key in [key for key, entry in self.entries.items()
+                    if predicate(entry[0])]:
+                del self.entries[key]
+                self._evicted(key)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self.lock:
+            keys = list(self.entries)
+            self.entries.clear()
+            for key in keys:
+                self._evicted(key)
+
+    def __contains__(self, key):
+        """Return True if the key is cached and has not expired."""
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        """Return the number of entries, including expired ones not yet
+        purged."""
+        return len(self.entries)
+
+
+class RateLimiter:
+
+    """
+    A token bucket limiting how often an operation may run.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        """
+        Create a new rate limiter.
+
+        :param rate: The sustained number of operations allowed per second.
+        :param burst: The number of operations which may run back to back.
+        :param clock: A callable returning the current time in seconds.
+        :param sleep: A callable used to wait for a token.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Take a token from the bucket.
+
+        :return: The number of seconds to wait before the token may be used.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Block until an operation is allowed to run."""
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+
+class RefreshAheadCache(TTLCache):
+
+    """
+    A TTLCache which reloads frequently used entries in the background before
+    they expire. Each entry remembers the loader used to fetch it and counts
+    the hits it receives. A monitor thread periodically looks for entries
+    which expire within the refresh window and have been hit at least
+    min_hits times since they were last loaded. Those entries are queued to a
+    bounded pool of worker threads which reload them, subject to a rate limit
+    on the number of reloads per second.
+
+    Entries which are not in demand are left to expire normally.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, refresh_window=10, min_hits=2,
+            workers=2, max_rate=50, queue_size=256, interval=1,
+            clock=time.time):
+        """
+        Create a new refresh-ahead cache.
+
+        :param max_size: The maximum number of entries to hold.
+        :param ttl: The number of seconds an entry remains valid.
+        :param refresh_window: Entries expiring within this many seconds are
+            candidates for a refresh.
+        :param min_hits: The number of hits an entry needs to be refreshed.
+        :param workers: The number of worker threads reloading entries.
+        :param max_rate: The maximum number of reloads per second.
+        :param queue_size: The maximum number of pending reloads. Candidates
+            found while the queue is full are skipped.
+        :param interval: The number of seconds between scans for candidates.
+        :param clock: A callable returning the current time in seconds.
+        """
+        TTLCache.__init__(self, max_size, ttl, clock)
+        self.refresh_window = refresh_window
+        self.min_hits = min_hits
+        self.workers = workers
+        self.interval = interval
+        self.limiter = RateLimiter(max_rate, max(1, workers))
+        self.queue = Queue(queue_size)
+        self.loaders = {}
+        self.hits = {}
+        self.pending = set()
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def _evicted(self, key):
+        """Drop the loader and hit count of a removed key."""
+        self.loaders.pop(key, None)
+        self.hits.pop(key, None)
+
+    def get(self, key, default=None):
+        """
+        Retrieve a value from the cache and count the hit.
+
+        :param key: The key to look up.
+        :param default: The value to return on a miss.
+        :return: The cached value or default if the key is absent or expired.
+        """
+        missing = object()
+        with self.lock:
+            value = TTLCache.get(self, key, missing)
+            if value is missing:
+                return default
+            self.hits[key] = self.hits.get(key, 0) + 1
+            return value
+
+    def fetch(self, key, loader):
+        """
+        Retrieve a value from the cache, loading and storing it on a miss.
+        The loader is kept so the entry can be refreshed later.
+
+        :param key: The key to look up.
+        :param loader: A callable taking no arguments which returns the value
+            for the key.
+        :return: The cached or loaded value.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = loader()
+            with self.lock:
+                self.set(key, value)
+                self.loaders[key] = loader
+                self.hits[key] = 0
+        return value
+
+    def scan(self):
+        """
+        Queue reloads for entries which are about to expire and still in
+        demand.
+
+        :return: The list of keys queued for a reload.
+        """
+        queued = []
+        with self.lock:
+            deadline = self.clock() + self.refresh_window
+            candidates = [key for key, entry in self.entries.items()
+                if entry[1] <= deadline and key not in self.pending and
+                key in self.loaders and self.hits.get(key, 0) >= self.min_hits]
+            for key in candidates:
+                try:
+                    self.queue.put_nowait(key)
+                except Full:
+                    break
+                self.pending.add(key)
+                queued.append(key)
+        return queued
+
+    def refresh(self, key):
+        """
+        Reload an entry using its loader and reset its hit count. Does nothing
+        if the entry has been removed in the meantime.
+
+        :param key: The key to reload.
+        """
+        with self.lock:
+            loader = self.loaders.get(key)
+        if loader is None:
+            return
+        value = loader()
+        with self.lock:
+            if key in self.loaders:
+                self.set(key, value)
+                self.hits[key] = 0
+
+    def _work(self):
+        """Reload queued entries until the cache is stopped."""
+        while True:
+            key = self.queue.get()
+            try:
+                if key is None:
+                    return
+                self.limiter.acquire()
+                self.refresh(key)
+            except Exception:
+                log.exception('failed to refresh cache entry %r', key)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+    def _monitor(self):
+        """Scan for refresh candidates until the cache is stopped."""
+        while not self.stopping.wait(self.interval):
+            self.scan()
+
+    def start(self):
+        """Start the monitor and worker threads."""
+        if self.threads:
+            return
+        self.stopping.clear()
+        targets = [self._monitor] + [self._work] * self.workers
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the monitor and worker threads and wait for them to exit."""
+        if not self.threads:
+            return
+        self.stopping.set()
+        for _ in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
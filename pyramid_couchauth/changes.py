@@ -0,0 +1,102 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Following the CouchDB _changes feed to keep in memory state current.
+"""
+
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class ChangesFollower:
+
+    """
+    Long polls the _changes feed of a database, filtered to the documents in
+    a view, and passes the ids of changed documents to a callback. Processes
+    use this to drop cached data as soon as it changes in any process.
+    """
+
+    def __init__(self, database, view, callback, timeout=10):
+        """
+        Create a new changes follower.
+
+        :param database: The database to follow.
+        :param view: The view whose documents are followed.
+        :param callback: A callable taking a list of changed document ids.
+        :param timeout: The number of seconds each long poll waits for a
+            change.
+        """
+        self.database = database
+        self.view = view
+        self.callback = callback
+        self.timeout = timeout
+        self.since = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def _update_seq(self):
+        """Return the current update sequence of the database."""
+        return self.database.info()['update_seq']
+
+    def _changes(self, since):
+        """
+        Long poll the _changes feed for changes to the view's documents.
+
+        :param since: The update sequence to report changes after.
+        :return: The decoded _changes response.
+        """
+        from couchdbkit import Consumer
+        return Consumer(self.database).wait_once(since=since, filter='_view',
+            view=self.view, timeout=int(self.timeout * 1000))
+
+    def reset(self):
+        """Follow changes made from now on."""
+        self.since = self._update_seq()
+
+    def poll(self):
+        """
+        Wait for changes and pass the ids of changed documents to the
+        callback if any arrive.
+
+        :return: True if there were changes, False otherwise.
+        """
+        if self.since is None:
+            self.reset()
+        result = self._changes(self.since)
+        self.since = result.get('last_seq', self.since)
+        ids = [change['id'] for change in result.get('results', [])]
+        if not ids:
+            return False
+        self.callback(ids)
+        return True
+
+    def _run(self):
+        """Follow changes until stopped."""
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+            except Exception:
+                log.exception('failed to follow changes to %s', self.view)
+                self.stopping.wait(self.timeout)
+
+    def start(self):
+        """Start following changes in a background thread."""
+        if self.thread is not None:
+            return
+        self.reset()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and wait for it to exit."""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
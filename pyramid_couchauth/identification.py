@@ -6,8 +6,11 @@
 Identification implementations.
 """
 
+import hashlib
 from zope.interface import implementer
 from pyramid.authentication import AuthTktCookieHelper
+from pyramid_couchauth.cache import TTLCache
+from pyramid_couchauth.changes import ChangesFollower
 from pyramid_couchauth.interfaces import IIdentifier
 
 
@@ -61,3 +64,161 @@ class AuthTktIdentifier:
         """
         return self.cookie.forget(request)
 
+
+def hash_token(token):
+    """
+    Hash a bearer token for storage. Only the hash of a token is stored in the
+    database and it is the key of the token hashes view.
+
+    :param token: The raw token.
+    :return: The hex encoded SHA-256 digest of the token.
+    """
+    if not isinstance(token, bytes):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+@implementer(IIdentifier)
+class BearerTokenIdentifier:
+
+    """
+    An identifier for machine clients which authenticate with an API key sent
+    as a bearer token in the Authorization header. Tokens are resolved to
+    usernames through a view keyed by the token hash. Lookups are cached.
+    Unknown tokens are cached separately in a smaller cache for a shorter
+    time so a flood of forged tokens cannot evict valid ones.
+
+    Once started, the identifier follows the _changes feed of the token
+    hashes view and evicts the tokens of changed documents, so a token
+    revoked in the database is rejected by every process within one long
+    poll rather than when its cached entry expires.
+
+    Tokens are issued out of band so remember and forget return no headers.
+    """
+
+    def __init__(self, database, token_hashes_view='pyramid/token_hashes',
+            cache=None, negative_ttl=5, negative_cache=None,
+            changes_timeout=10):
+        """
+        Initialize the identifier.
+
+        :param database: The database where token hashes are stored.
+        :param token_hashes_view: A view which maps usernames (the values) to
+            token hashes (the keys). See hash_token.
+        :param cache: The cache used to store token lookups. Defaults to a
+            TTLCache holding 10000 tokens for 5 minutes.
+        :param negative_ttl: The number of seconds to cache unknown tokens.
+        :param negative_cache: The cache used to store unknown tokens.
+            Defaults to a TTLCache holding 1000 tokens for negative_ttl
+            seconds.
+        :param changes_timeout: The number of seconds each long poll of the
+            _changes feed waits for a change.
+        """
+        if cache is None:
+            cache = TTLCache(max_size=10000, ttl=300)
+        if negative_cache is None:
+            negative_cache = TTLCache(max_size=1000, ttl=negative_ttl)
+        self.database = database
+        self.token_hashes_view = token_hashes_view
+        self.cache = cache
+        self.negative_cache = negative_cache
+        self.changes = ChangesFollower(database, token_hashes_view,
+            self.changed, changes_timeout)
+
+    def _token(self, request):
+        """
+        Extract the bearer token from a request.
+
+        :param request: The WSGI request.
+        :return: The token or None if no bearer token was sent.
+        """
+        header = request.headers.get('Authorization')
+        if not header:
+            return None
+        scheme, _, token = header.strip().partition(' ')
+        if scheme.lower() != 'bearer' or not token.strip():
+            return None
+        return token.strip()
+
+    def identify(self, request):
+        """
+        Return the username the bearer token belongs to.
+
+        :param request: The WSGI request.
+        :return: The username or None if the token is missing or unknown.
+        """
+        token = self._token(request)
+        if token is None:
+            return None
+        token_hash = hash_token(token)
+
+        entry = self.cache.get(token_hash)
+        if entry is not None:
+            return entry[0]
+        if token_hash in self.negative_cache:
+            return None
+        rows = list(self.database.view(self.token_hashes_view, key=token_hash))
+        if not rows:
+            self.negative_cache.set(token_hash, True)
+            return None
+        self.cache.set(token_hash, (rows[0]['value'], rows[0]['id']))
+        return rows[0]['value']
+
+    def changed(self, ids):
+        """
+        Evict the tokens of changed token documents. Unknown tokens are all
+        forgotten since a changed document may hold a newly issued token.
+
+        :param ids: The ids of the changed documents.
+        """
+        ids = set(ids)
+        self.cache.invalidate_values(lambda entry: entry[1] in ids)
+        self.negative_cache.clear()
+
+    def start(self):
+        """Start following changes to the token hashes view."""
+        self.changes.start()
+
+    def stop(self):
+        """Stop following changes to the token hashes view."""
+        self.changes.stop()
+
+    def revoke(self, token):
+        """
+        Evict a revoked token from the caches of this process immediately. The
+        token must also be removed from the database, which other processes
+        see through the _changes feed once started. Call this after issuing a
+        token as well so a previous unknown lookup is forgotten.
+
+        :param token: The raw token.
+        """
+        self.revoke_hash(hash_token(token))
+
+    def revoke_hash(self, token_hash):
+        """
+        Evict a revoked token from the caches by its hash.
+
+        :param token_hash: The token hash as returned by hash_token.
+        """
+        self.cache.invalidate(token_hash)
+        self.negative_cache.invalidate(token_hash)
+
+    def remember(self, request, username, **kw):
+        """
+        Return no headers. Bearer tokens are issued out of band.
+
+        :param request: The WSGI request.
+        :param username: The username to remember.
+        :param kw: Additional identifier parameters.
+        :return: An empty list.
+        """
+        return []
+
+    def forget(self, request):
+        """
+        Return no headers. Bearer tokens are revoked out of band.
+
+        :param request: The WSGI request.
+        :return: An empty list.
+        """
+        return []
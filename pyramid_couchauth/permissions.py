@@ -0,0 +1,144 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Hierarchical permission matching.
+
+Permissions are dotted names such as billing.invoice.read. A grant may use *
+in place of a segment. A trailing * matches one or more remaining segments, so
+billing.* grants billing.invoice and billing.invoice.read but not billing. A *
+anywhere else matches exactly one segment, so billing.*.read grants
+billing.invoice.read but not billing.invoice.write.
+"""
+
+SEPARATOR = '.'
+WILDCARD = '*'
+
+
+class _Node:
+
+    """A node in a PermissionTrie."""
+
+    __slots__ = ('children', 'exact', 'tail')
+
+    def __init__(self):
+        """Create an empty node."""
+        self.children = {}
+        self.exact = False
+        self.tail = False
+
+
+class PermissionTrie:
+
+    """
+    A prefix trie of permission grants. Checking a permission walks the trie
+    one segment at a time, so its cost depends on the depth of the permission
+    rather than the number of grants.
+    """
+
+    def __init__(self, grants=()):
+        """
+        Create a trie.
+
+        :param grants: An iterable of grants to add.
+        """
+        self.root = _Node()
+        for grant in grants:
+            self.add(grant)
+
+    def add(self, grant):
+        """
+        Add a grant to the trie.
+
+        :param grant: The dotted grant, optionally containing wildcards.
+        """
+        segments = grant.split(SEPARATOR)
+        node = self.root
+        for segment in segments[:-1]:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        last = segments[-1]
+        if last == WILDCARD:
+            node.tail = True
+        else:
+            child = node.children.get(last)
+            if child is None:
+                child = node.children[last] = _Node()
+            child.exact = True
+
+    def _match(self, node, segments, index):
+        """
+        Match the remaining segments of a permission against a node.
+
+        :param node: The node to match from.
+        :param segments: The segments of the permission.
+        :param index: The index of the next segment to match.
+        :return: True if a grant matches, False otherwise.
+        """
+        if index == len(segments):
+            return node.exact
+        if node.tail:
+            return True
+        child = node.children.get(segments[index])
+        if child is not None and self._match(child, segments, index + 1):
+            return True
+        child = node.children.get(WILDCARD)
+        if child is not None and self._match(child, segments, index + 1):
+            return True
+        return False
+
+    def match(self, permission):
+        """
+        Check if any grant in the trie covers a permission.
+
+        :param permission: The dotted permission to check.
+        :return: True if the permission is granted, False otherwise.
+        """
+        return self._match(self.root, permission.split(SEPARATOR), 0)
+
+
+class PermissionTries:
+
+    """
+    The union of several permission tries. Used to check the permissions of
+    a set of principals against their individually compiled tries.
+    """
+
+    def __init__(self, tries=()):
+        """
+        Create a union of tries.
+
+        :param tries: An iterable of PermissionTrie objects.
+        """
+        self.tries = tuple(tries)
+
+    def match(self, permission):
+        """
+        Check if a grant in any of the tries covers a permission.
+
+        :param permission: The dotted permission to check.
+        :return: True if the permission is granted, False otherwise.
+        """
+        for trie in self.tries:
+            if trie.match(permission):
+                return True
+        return False
+
+
+def covering_grants(permission):
+    """
+    Return the grants which cover a permission without a wildcard in the
+    middle. For billing.invoice.read these are billing.invoice.read,
+    billing.invoice.*, billing.* and *.
+
+    :param permission: The dotted permission.
+    :return: A list of grants, most specific first.
+    """
+    segments = permission.split(SEPARATOR)
+    grants = [permission]
+    for index in range(len(segments) - 1, -1, -1):
+        grants.append(SEPARATOR.join(segments[:index] + [WILDCARD]))
+    return grants
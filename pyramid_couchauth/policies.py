@@ -9,7 +9,152 @@ Policies for auth/auth against CouchDB.
 from zope.interface import implementer
 from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
 from pyramid.security import Authenticated, Everyone
+from pyramid.threadlocal import get_current_request
+from pyramid.traversal import resource_path
+from pyramid_couchauth.cache import TTLCache
+from pyramid_couchauth.permissions import (PermissionTrie, PermissionTries,
+    covering_grants)
 from pyramid_couchauth.principal import Principal
+from pyramid_couchauth.tweens import timed
+
+
+def _tracked(principals, checked):
+    """
+    Iterate over principals, appending each one to a list as it is produced.
+    Used to audit the principals a decision was based on without expanding
+    more of a LazyPrincipals sequence than permits does.
+
+    :param principals: The principals to iterate over.
+    :param checked: The list to append principals to.
+    """
+    for principal in principals:
+        checked.append(principal)
+        yield principal
+
+
+def _context_name(context):
+    """
+    Identify a permission check context for the audit log.
+
+    :param context: The context in which permission checking is occuring.
+    :return: The resource path of a location aware context, the class name
+        of any other context or None if there is no context.
+    """
+    if context is None:
+        return None
+    if hasattr(context, '__name__') and hasattr(context, '__parent__'):
+        return resource_path(context)
+    return '%s.%s' % (type(context).__module__, type(context).__name__)
+
+
+def _audited_user(principals):
+    """
+    Find the user a decision was made for without expanding principals.
+
+    :param principals: The principals the decision was made for.
+    :return: A tuple of the authenticated username and the claimed username.
+        A lazy sequence which was not expanded far enough to show the user
+        exists only yields the claimed username, which is unverified.
+    """
+    if isinstance(principals, LazyPrincipals):
+        if Authenticated in principals.principals:
+            return principals.username, None
+        return None, principals.username
+    for principal in principals:
+        pobj = Principal(principal)
+        if pobj.type == 'user':
+            return pobj.name, None
+    return None, None
+
+
+class LazyPrincipals:
+
+    """
+    A sequence of effective principals which queries the database only as far
+    as it is iterated. Principals are produced in the order Everyone,
+    Authenticated, the user principal and then group principals. Stopping
+    iteration early, as permits does when a user level grant is found, avoids
+    the group query entirely. Taking the length or indexing the sequence
+    expands it fully.
+    """
+
+    def __init__(self, policy, request, username):
+        """
+        Create a new lazy principal sequence.
+
+        :param policy: The CouchAuthenticationPolicy used to look up the user.
+            May be None if username is None.
+        :param request: The WSGI request.
+        :param username: The unauthenticated username or None.
+        """
+        self.policy = policy
+        self.request = request
+        self.username = username
+        self.principals = [Everyone]
+        self.stages = [self._expand_user, self._expand_groups]
+        if username is None:
+            self.stages = []
+
+    def _expand_user(self):
+        """Return the principals for an existing user."""
+        with timed(self.request, 'expand'):
+            exists = self.policy._user_exists(self.username)
+        if not exists:
+            self.stages = []
+            return []
+        pobj = Principal(self.username, 'user')
+        return [Authenticated, str(pobj)]
+
+    def _expand_groups(self):
+        """Return the principals for the groups the user belongs to."""
+        with timed(self.request, 'expand'):
+            groups = self.policy._user_groups(self.username)
+        return [str(Principal(type='group', name=group)) for group in groups]
+
+    def _advance(self):
+        """
+        Run the next expansion stage.
+
+        :return: False if the sequence is fully expanded, True otherwise.
+        """
+        if not self.stages:
+            return False
+        stage = self.stages.pop(0)
+        self.principals.extend(stage())
+        return True
+
+    def __iter__(self):
+        """Iterate over the principals, expanding as needed."""
+        index = 0
+        while True:
+            while index < len(self.principals):
+                yield self.principals[index]
+                index += 1
+            if not self._advance():
+                return
+
+    def __contains__(self, principal):
+        """Return True if the principal is effective."""
+        for item in self:
+            if item == principal:
+                return True
+        return False
+
+    def __len__(self):
+        """Return the number of principals."""
+        while self._advance():
+            pass
+        return len(self.principals)
+
+    def __getitem__(self, index):
+        """Return the principal at the given index."""
+        while self._advance():
+            pass
+        return self.principals[index]
+
+    def __repr__(self):
+        """Create a string representation of the object."""
+        return '<LazyPrincipals(%s)>' % ', '.join(self.principals)
 
 
 @implementer(IAuthenticationPolicy)
@@ -19,7 +164,8 @@ class CouchAuthenticationPolicy:
 
     def __init__(self, database, identifier, 
             user_names_view='pyramid/user_names',
-            user_groups_view='pyramid/user_groups'):
+            user_groups_view='pyramid/user_groups',
+            cache=None, user_filter=None, audit=None):
         """
         Create a new CouchDB authentication policy object.
 
@@ -33,34 +179,86 @@ class CouchAuthenticationPolicy:
         :param identifier: The identifier object to use. The identifier is used
             to store authenticated user information. It must implement the
             IIdentifier interface.
+        :param cache: An optional cache used to store the results of user
+            name and group lookups. See pyramid_couchauth.cache. A None value
+            queries the database on every lookup.
+        :param user_filter: An optional UserNameFilter used to reject unknown
+            usernames without querying the database. See
+            pyramid_couchauth.bloom.
+        :param audit: An optional AuditLog which records calls to remember
+            and forget. See pyramid_couchauth.audit.
         """
         self.identifier = identifier
         self.database = database
         self.user_names_view = user_names_view
         self.user_groups_view = user_groups_view
+        self.cache = cache
+        self.user_filter = user_filter
+        self.audit = audit
 
-    def _expand_principal(self, principal):
+    def _lookup(self, view, key, loader):
         """
-        Expand a user principal into a list of principals. If the user exists
-        then the resulting list will contain the Authenticated principal, the
-        user principal, and a principal for each group the user belongs to.
+        Call a loader for a view key, consulting the cache if one is set.
 
-        :param principal: The user principal to expand.
-        :return: The list of expanded principals. The list will be empty if the
-            user does not exist.
+        :param view: The name of the view being queried.
+        :param key: The key being queried.
+        :param loader: A callable taking no arguments which queries the view.
+        :return: The loaded value.
         """
-        principals = []
-        pobj = Principal(principal, 'user')
-        users = self.database.view(self.user_names_view, key=pobj.name)
+        if self.cache is None:
+            return loader()
+        return self.cache.fetch((view, key), loader)
 
-        if len(users) > 0:
-            principals.append(Authenticated)
-            principals.append(str(pobj))
+    def _user_exists(self, username):
+        """
+        Check if a user exists.
 
-            groups = self.database.view(self.user_groups_view, key=pobj.name)
-            for group in groups:
-                principals.append(str(Principal(type='group', name=group['value'])))
-        return principals
+        :param username: The username to check.
+        :return: True if the user exists, False otherwise.
+        """
+        if (self.user_filter is not None and
+                not self.user_filter.might_exist(username)):
+            return False
+
+        def load():
+            users = self.database.view(self.user_names_view, key=username)
+            return len(users) > 0
+        return self._lookup(self.user_names_view, username, load)
+
+    def _user_groups(self, username):
+        """
+        Retrieve the names of the groups a user belongs to.
+
+        :param username: The username to retrieve groups for.
+        :return: A list of group names.
+        """
+        def load():
+            groups = self.database.view(self.user_groups_view, key=username)
+            return [group['value'] for group in groups]
+        return self._lookup(self.user_groups_view, username, load)
+
+    def invalidate(self, principal=None):
+        """
+        Forget cached user lookups after users or group memberships have
+        changed. Memberships are cached per user, so invalidating a group
+        forgets the groups of every user.
+
+        :param principal: The user or group principal which changed. A None
+            value forgets every user lookup.
+        """
+        if self.cache is None:
+            return
+        views = (self.user_names_view, self.user_groups_view)
+        pobj = Principal(principal) if principal is not None else None
+        if pobj is not None and pobj.type == 'user':
+            for view in views:
+                self.cache.invalidate((view, pobj.name))
+        elif pobj is not None:
+            self.cache.invalidate_matching(lambda key: isinstance(key, tuple)
+                and len(key) == 2 and key[0] == self.user_groups_view)
+        else:
+            self.cache.invalidate_matching(lambda key: isinstance(key, tuple)
+                and len(key) == 2 and key[0] in views)
 
     def unauthenticated_userid(self, request):
         """
@@ -68,7 +266,8 @@ class CouchAuthenticationPolicy:
         :param request: The WSGI request.
         :return: The unauthenticated username or None if no user is present.
         """
-        return self.identifier.identify(request)
+        with timed(request, 'identify'):
+            return self.identifier.identify(request)
 
     def authenticated_userid(self, request):
         """
@@ -80,22 +279,22 @@ class CouchAuthenticationPolicy:
         """
         username = self.unauthenticated_userid(request)
         if username is not None:
-            users = self.database.view(self.user_names_view, key=username)
-            if len(users) > 0:
-                return username
+            with timed(request, 'expand'):
+                if self._user_exists(username):
+                    return username
         return None
 
     def effective_principals(self, request):
         """
-        Retrieve the effective principals for the current request.
+        Retrieve the effective principals for the current request. The
+        principals are expanded lazily: the user is only looked up once
+        iteration passes Everyone and groups are only queried once iteration
+        passes the user principal.
         :param request: The WSGI request.
-        :return: A list of principals.
+        :return: A LazyPrincipals sequence.
         """
-        principals = [Everyone]
         username = self.unauthenticated_userid(request)
-        if username is not None:
-            principals.extend(self._expand_principal(username))
-        return principals
+        return LazyPrincipals(self, request, username)
 
     def remember(self, request, principal, **kw):
         """
@@ -107,6 +306,11 @@ class CouchAuthenticationPolicy:
         :return: A list of headers.
         """
         pobj = Principal(principal, 'user')
+        if self.user_filter is not None:
+            self.user_filter.add(pobj.name)
+        if self.audit is not None:
+            self.audit.record('remember', userid=pobj.name,
+                principal=str(pobj))
         return self.identifier.remember(request, pobj.name, **kw)
 
     def forget(self, request):
@@ -116,6 +320,9 @@ class CouchAuthenticationPolicy:
         :param request: The WSGI request.
         :return: A list of headers.
         """
+        if self.audit is not None:
+            self.audit.record('forget',
+                claimed_userid=self.unauthenticated_userid(request))
         return self.identifier.forget(request)
 
 
@@ -128,7 +335,9 @@ class CouchAuthorizationPolicy:
             user_perms_view=None,
             group_perms_view='pyramid/group_perms',
             perm_users_view=None,
-            perm_groups_view='pyramid/perm_groups'):
+            perm_groups_view='pyramid/perm_groups',
+            hierarchical=False, cache=None, audit=None, decision_cache=None,
+            trie_cache=None, authentication=None):
         """
         Creates a new CouchDB authorization policy.
         :param database: The database where authorization data is stored.
@@ -148,12 +357,104 @@ class CouchAuthorizationPolicy:
             permission names (the keys). A None value disables permission group
             mapping. This is useful if you wish all permissions to be
             controlled at the user level.
+        :param hierarchical: Treat permissions as dotted names and allow
+            grants to contain wildcards. See pyramid_couchauth.permissions.
+            Each principal's grants are compiled into a PermissionTrie.
+        :param cache: An optional cache used to store each principal's grants.
+            See pyramid_couchauth.cache. A None value queries the database on
+            every check.
+        :param audit: An optional AuditLog which records every decision made
+            by permits. See pyramid_couchauth.audit.
+        :param decision_cache: An optional cache of permits decisions.
+            Decisions for a LazyPrincipals sequence are keyed by the username
+            and the permission, so a hit needs no queries at all. Other
+            principals are keyed by their set. A miss is checked as without
+            the cache and expands lazy principals only as far as needed. Call
+            invalidate when grants or group memberships change.
+        :param trie_cache: The cache used to store compiled tries when
+            permissions are hierarchical. Tries are always cached since
+            compiling one costs more than the query it is built from.
+            Defaults to a TTLCache of 1024 tries for 60 seconds.
+        :param authentication: The CouchAuthenticationPolicy whose cached user
+            lookups invalidate also forgets, so decisions are not recomputed
+            from stale group memberships.
         """
         self.database = database
         self.user_perms_view = user_perms_view
         self.group_perms_view = group_perms_view
         self.perm_users_view = perm_users_view
         self.perm_groups_view = perm_groups_view
+        self.hierarchical = hierarchical
+        self.cache = cache
+        self.audit = audit
+        self.decision_cache = decision_cache
+        if hierarchical and trie_cache is None:
+            trie_cache = TTLCache(1024, 60)
+        self.trie_cache = trie_cache
+        self.authentication = authentication
+
+    def _grants_view(self, principal):
+        """
+        Find the view holding the grants of a principal.
+
+        :param principal: The principal string.
+        :return: A tuple of the view name and the principal name. The view
+            name is None if grants for the principal are disabled.
+        """
+        if principal == Everyone:
+            pobj = Principal(type='user', name=Everyone)
+        else:
+            pobj = Principal(principal)
+        if pobj.type == 'user':
+            return self.user_perms_view, pobj.name
+        elif pobj.type == 'group':
+            return self.group_perms_view, pobj.name
+        return None, pobj.name
+
+    def _lookup(self, key, loader):
+        """
+        Call a loader for a key, consulting the cache if one is set.
+
+        :param key: The cache key.
+        :param loader: A callable taking no arguments which loads the value.
+        :return: The loaded value.
+        """
+        if self.cache is None:
+            return loader()
+        return self.cache.fetch(key, loader)
+
+    def _grants(self, view, name):
+        """
+        Retrieve the permissions granted to a principal.
+
+        :param view: The view holding the grants.
+        :param name: The name of the principal.
+        :return: A list of granted permissions.
+        """
+        return self._lookup((view, name), lambda: self._load_grants(view, name))
+
+    def _load_grants(self, view, name):
+        """
+        Query the permissions granted to a principal.
+
+        :param view: The view holding the grants.
+        :param name: The name of the principal.
+        :return: A list of granted permissions.
+        """
+        return [perm['value'] for perm in self.database.view(view, key=name)]
+
+    def _trie(self, view, name):
+        """
+        Retrieve the compiled permission trie of a principal. Tries are
+        compiled from grants queried directly so a refreshed trie never
+        reuses stale cached grants.
+
+        :param view: The view holding the grants.
+        :param name: The name of the principal.
+        :return: A PermissionTrie of the principal's grants.
+        """
+        load = lambda: PermissionTrie(self._load_grants(view, name))
+        return self.trie_cache.fetch((view, name), load)
 
     def permits(self, context, principals, permission):
         """
@@ -165,39 +466,173 @@ class CouchAuthorizationPolicy:
         :return: True if one of the principals has the permission, false
             otherwise.
         """
+        with timed(get_current_request(), 'permits'):
+            if self.decision_cache is not None:
+                allowed, checked = self._cached_permits(principals,
+                    permission)
+            elif self.audit is not None:
+                checked = []
+                allowed = self._permits(_tracked(principals, checked),
+                    permission)
+            else:
+                return self._permits(principals, permission)
+
+            if self.audit is not None:
+                userid, claimed_userid = _audited_user(principals)
+                self.record(context, userid, checked, permission, allowed,
+                    claimed_userid)
+            return allowed
+
+    def _cached_permits(self, principals, permission):
+        """
+        Check a permission through the decision cache.
+
+        :param principals: The principals to check.
+        :param permission: The permission to check the principals for.
+        :return: A tuple of the decision and the list of principals it was
+            based on. The list is None if the decision was cached.
+        """
+        if isinstance(principals, LazyPrincipals):
+            key = ('user', principals.username, permission)
+        else:
+            principals = frozenset(principals)
+            key = ('principals', principals, permission)
+        checked = []
+        loaded = []
+
+        def load():
+            loaded.append(True)
+            return self._permits(_tracked(principals, checked), permission)
+        allowed = self.decision_cache.fetch(key, load)
+        return allowed, checked if loaded else None
+
+    def record(self, context, userid, principals, permission, allowed,
+            claimed_userid=None):
+        """
+        Record a permits decision in the audit log.
+
+        :param context: The context in which permission checking occured.
+        :param userid: The username of the authenticated user the decision
+            was made for, or None.
+        :param principals: The principals the decision was based on, or None
+            if the decision was cached.
+        :param permission: The permission checked.
+        :param allowed: The decision.
+        :param claimed_userid: The unverified username of a user who was not
+            shown to be authenticated, or None.
+        """
+        request = get_current_request()
+        self.audit.record('permits', userid=userid,
+            claimed_userid=claimed_userid, context=_context_name(context),
+            path=request.path if request is not None else None,
+            principals=principals, permission=permission, allowed=allowed)
+
+    def permissions_for(self, principals):
+        """
+        Load every permission granted to a set of principals. Grants are
+        read through the grant cache if one is set, and hierarchical grants
+        through the cached trie of each principal, so no trie is compiled
+        per call.
+
+        :param principals: The principals to load permissions for.
+        :return: A frozenset of permissions, or a PermissionTries of the
+            principals' tries if permissions are hierarchical.
+        """
+        grants = []
         for principal in principals:
-            if principal == Everyone:
-                pobj = Principal(type='user', name=Everyone)
+            view, name = self._grants_view(principal)
+            if view is None:
+                continue
+            if self.hierarchical:
+                grants.append(self._trie(view, name))
             else:
-                pobj = Principal(principal)
-            if pobj.type == 'user' and self.user_perms_view is not None:
-                perms = self.database.view(self.user_perms_view, key=pobj.name)
-                for perm in perms:
-                    if perm['value'] == permission:
-                        return True
-            elif pobj.type == 'group' and self.group_perms_view is not None:
-                perms = self.database.view(self.group_perms_view, key=pobj.name)
-                for perm in perms:
-                    if perm['value'] == permission:
-                        return True
+                grants.extend(self._grants(view, name))
+        if self.hierarchical:
+            return PermissionTries(grants)
+        return frozenset(grants)
+
+    def _permits(self, principals, permission):
+        """
+        Return True if any of the principals have the provided permission.
+        :param principals: The list of principals to check.
+        :param permission: The permission to check the principals for.
+        :return: True if one of the principals has the permission, false
+            otherwise.
+        """
+        for principal in principals:
+            view, name = self._grants_view(principal)
+            if view is None:
+                continue
+            if self.hierarchical:
+                if self._trie(view, name).match(permission):
+                    return True
+            elif permission in self._grants(view, name):
+                return True
         return False
 
+    def invalidate(self, principal=None):
+        """
+        Forget cached grants and decisions after grant data has changed.
+
+        Decisions cached by username depend on the user's groups, so
+        invalidating a group, or Everyone, forgets the decisions of every
+        user. Invalidate a user principal after changing its groups. The
+        user lookups of the authentication policy, if set, are forgotten
+        first so the next decision sees the new groups.
+
+        :param principal: The principal whose grants or groups changed. A
+            None value forgets the grants of every principal.
+        """
+        if self.authentication is not None:
+            self.authentication.invalidate(principal)
+        if principal is None:
+            views = set([self.user_perms_view, self.group_perms_view])
+            views.discard(None)
+            grant = lambda key: key[-2] in views
+            decision = lambda key: True
+        else:
+            view, name = self._grants_view(principal)
+            grant = lambda key: key[-2:] == (view, name)
+            pobj = Principal(principal)
+            if pobj.type == 'user':
+                user = lambda key: key[1] == pobj.name
+            else:
+                user = lambda key: True
+            decision = lambda key: (user(key) if key[0] == 'user'
+                else principal in key[1])
+        for cache in (self.cache, self.trie_cache):
+            if cache is not None:
+                cache.invalidate_matching(
+                    lambda key: isinstance(key, tuple) and len(key) >= 2 and
+                    grant(key))
+        if self.decision_cache is not None:
+            self.decision_cache.invalidate_matching(decision)
+
     def principals_allowed_by_permission(self, context, permission):
         """
         Return a list of principals who have the provided permission in the
         given context.
         :param context: The context in which permission checking is occuring.
         :param permission: The permission to retrieve principals for.
-        :return: A list of principals which contain the given permission.
+        :return: A list of principals which contain the given permission. For
+            hierarchical permissions this includes principals holding a
+            trailing wildcard grant which covers the permission. Every
+            covering grant is fetched in one multi-key query per view.
         """
+        if self.hierarchical:
+            query = {'keys': covering_grants(permission)}
+        else:
+            query = {'key': permission}
         principals = []
-        if self.perm_users_view is not None:
-            users = self.database.view(self.perm_users_view, key=permission)
-            pstrs = [str(Principal(type='user', name=user['value'])) for user in users]
-            principals.extend(pstrs)
-        if self.perm_groups_view is not None:
-            groups = self.database.view(self.perm_groups_view, key=permission)
-            pstrs = [str(Principal(type='group', name=group['value'])) for group in groups]
-            principals.extend(pstrs)
+        seen = set()
+        for view, type in ((self.perm_users_view, 'user'),
+                (self.perm_groups_view, 'group')):
+            if view is None:
+                continue
+            for row in self.database.view(view, **query):
+                pstr = str(Principal(type=type, name=row['value']))
+                if pstr not in seen:
+                    seen.add(pstr)
+                    principals.append(pstr)
         return principals
 
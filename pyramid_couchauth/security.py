@@ -0,0 +1,222 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Security policy for Pyramid 2.x.
+"""
+
+from collections import namedtuple
+from zope.interface import implementer
+from pyramid.interfaces import ISecurityPolicy
+from pyramid.security import Allowed, Authenticated, Denied, Everyone
+from pyramid_couchauth.policies import LazyPrincipals
+from pyramid_couchauth.tweens import timed
+
+IDENTITY_KEY = 'couchauth.identity'
+
+
+class CouchIdentity(namedtuple('CouchIdentity',
+        'userid principals permissions')):
+
+    """
+    The immutable identity of an authenticated user.
+
+    userid -- The username.
+    principals -- A frozenset of the user's effective principals.
+    permissions -- The permissions granted to the principals if they were
+        prefetched, otherwise None. A frozenset of permissions, or an object
+        with a match method, such as a PermissionTries, for hierarchical
+        permissions.
+    """
+
+    __slots__ = ()
+
+    def allows(self, permission):
+        """
+        Check a permission against the prefetched permissions.
+
+        :param permission: The permission to check.
+        :return: True if the permission is granted, False otherwise.
+        """
+        if isinstance(self.permissions, frozenset):
+            return permission in self.permissions
+        return self.permissions.match(permission)
+
+
+@implementer(ISecurityPolicy)
+class CouchSecurityPolicy:
+
+    """
+    A Pyramid 2.x security policy built from a CouchAuthenticationPolicy and
+    a CouchAuthorizationPolicy. The identity of a request is resolved once
+    into a CouchIdentity, which request.identity, authenticated_userid and
+    permits all reuse.
+
+    Prefetched permissions last for a single request. They are loaded
+    through the authorization policy's grant cache, so invalidate applies
+    from the next request on. Checks against them never consult the decision
+    cache since they need no queries, but they are audited like any other
+    check.
+    """
+
+    def __init__(self, authentication, authorization,
+            prefetch_permissions=False):
+        """
+        Create a new security policy.
+
+        :param authentication: The CouchAuthenticationPolicy used to identify
+            users and expand their principals.
+        :param authorization: The CouchAuthorizationPolicy used to check
+            permissions.
+        :param prefetch_permissions: Load every permission granted to the
+            user's principals while resolving the identity, so permission
+            checks need no further queries.
+        """
+        self.authentication = authentication
+        self.authorization = authorization
+        self.prefetch_permissions = prefetch_permissions
+
+    def _policies(self, request):
+        """
+        Return the policies used for a request. Subclasses override this to
+        select policies per request.
+
+        :param request: The WSGI request.
+        :return: A tuple of the authentication and authorization policies.
+            Both are None if the request cannot be authenticated.
+        """
+        return self.authentication, self.authorization
+
+    def _resolve(self, request):
+        """
+        Resolve the identity of a request.
+
+        :param request: The WSGI request.
+        :return: A CouchIdentity or None if no user is authenticated.
+        """
+        authentication, authorization = self._policies(request)
+        if authentication is None:
+            return None
+        username = authentication.unauthenticated_userid(request)
+        if username is None:
+            return None
+        principals = frozenset(LazyPrincipals(authentication, request,
+            username))
+        if Authenticated not in principals:
+            return None
+        permissions = None
+        if self.prefetch_permissions:
+            permissions = authorization.permissions_for(principals)
+        return CouchIdentity(username, principals, permissions)
+
+    def identity(self, request):
+        """
+        Return the identity of the current user, resolving it on first use.
+
+        :param request: The WSGI request.
+        :return: A CouchIdentity or None if no user is authenticated.
+        """
+        missing = object()
+        identity = request.environ.get(IDENTITY_KEY, missing)
+        if identity is missing:
+            identity = self._resolve(request)
+            request.environ[IDENTITY_KEY] = identity
+        return identity
+
+    def authenticated_userid(self, request):
+        """
+        Return the username of the current user.
+
+        :param request: The WSGI request.
+        :return: The username or None if no user is authenticated.
+        """
+        identity = self.identity(request)
+        return identity.userid if identity is not None else None
+
+    def permits(self, request, context, permission):
+        """
+        Check if the current user has a permission in the given context.
+
+        :param request: The WSGI request.
+        :param context: The context in which permission checking is occuring.
+        :param permission: The permission to check.
+        :return: An Allowed or Denied object.
+        """
+        authorization = self._policies(request)[1]
+        if authorization is None:
+            return Denied('permission %r denied' % permission)
+        identity = self.identity(request)
+        if identity is not None and identity.permissions is not None:
+            with timed(request, 'permits'):
+                allowed = identity.allows(permission)
+            if authorization.audit is not None:
+                authorization.record(context, identity.userid,
+                    sorted(identity.principals), permission, allowed)
+        else:
+            if identity is not None:
+                principals = identity.principals
+            else:
+                principals = [Everyone]
+            allowed = authorization.permits(context, principals, permission)
+        if allowed:
+            return Allowed('permission %r granted' % permission)
+        return Denied('permission %r denied' % permission)
+
+    def remember(self, request, userid, **kw):
+        """
+        Return a set of headers suitable for "remembering" the given user.
+
+        :param request: The WSGI request.
+        :param userid: The username to remember.
+        :param kw: Additional parameters.
+        :return: A list of headers.
+        """
+        authentication = self._policies(request)[0]
+        if authentication is None:
+            return []
+        return authentication.remember(request, userid, **kw)
+
+    def forget(self, request, **kw):
+        """
+        Return a set of headers suitable for "forgetting" the current user.
+
+        :param request: The WSGI request.
+        :param kw: Additional parameters.
+        :return: A list of headers.
+        """
+        authentication = self._policies(request)[0]
+        if authentication is None:
+            return []
+        return authentication.forget(request)
+
+
+class TenantSecurityPolicy(CouchSecurityPolicy):
+
+    """
+    A Pyramid 2.x security policy which uses the policies of the request's
+    tenant. Requests without a tenant, or with an unknown one, are
+    unauthenticated and denied every permission.
+    """
+
+    def __init__(self, registry, prefetch_permissions=False):
+        """
+        Create a new tenant security policy.
+
+        :param registry: The TenantRegistry holding the tenant policies. See
+            pyramid_couchauth.tenancy.
+        :param prefetch_permissions: Load every permission granted to the
+            user's principals while resolving the identity.
+        """
+        CouchSecurityPolicy.__init__(self, None, None,
+            prefetch_permissions=prefetch_permissions)
+        self.registry = registry
+
+    def _policies(self, request):
+        """
+        Return the policies of the request's tenant.
+
+        :param request: The WSGI request.
+        :return: A tuple of the authentication and authorization policies.
+        """
+        return self.registry.policies(request)
@@ -0,0 +1,382 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Multi-tenant policies which select a CouchDB database per request.
+"""
+
+import re
+from zope.interface import implementer
+from pyramid.interfaces import IAuthenticationPolicy, IAuthorizationPolicy
+from pyramid.threadlocal import get_current_request
+from pyramid_couchauth.cache import TTLCache
+from pyramid_couchauth.interfaces import IIdentifier
+from pyramid_couchauth.policies import LazyPrincipals
+
+TENANT_PATTERN = '^[a-z0-9][a-z0-9_-]*$'
+
+
+class HostTenantResolver:
+
+    """
+    Resolve the tenant from the host name of the request.
+    """
+
+    def __init__(self, suffix=None):
+        """
+        Create a new resolver.
+
+        :param suffix: A domain suffix to strip from the host name, such as
+            .example.com. Hosts without the suffix resolve to no tenant. A
+            None value uses the full host name.
+        """
+        self.suffix = suffix
+
+    def __call__(self, request):
+        """
+        Return the tenant of a request.
+
+        :param request: The WSGI request.
+        :return: The tenant name or None.
+        """
+        host = request.host.rsplit(':', 1)[0].lower()
+        if self.suffix is None:
+            return host or None
+        if not host.endswith(self.suffix) or host == self.suffix:
+            return None
+        return host[:-len(self.suffix)]
+
+
+class PathTenantResolver:
+
+    """
+    Resolve the tenant from a segment of the request path.
+    """
+
+    def __init__(self, segment=0):
+        """
+        Create a new resolver.
+
+        :param segment: The index of the path segment naming the tenant.
+        """
+        self.segment = segment
+
+    def __call__(self, request):
+        """
+        Return the tenant of a request.
+
+        :param request: The WSGI request.
+        :return: The tenant name or None.
+        """
+        segments = [s for s in request.path_info.split('/') if s]
+        if self.segment < len(segments):
+            return segments[self.segment]
+        return None
+
+
+class ServerDatabaseFactory:
+
+    """
+    Create tenant databases from a single couchdbkit server so all tenants
+    share its connection pool.
+    """
+
+    def __init__(self, server, name_format='%s'):
+        """
+        Create a new factory.
+
+        :param server: The couchdbkit server.
+        :param name_format: The format used to build a database name from the
+            tenant name.
+        """
+        self.server = server
+        self.name_format = name_format
+
+    def __call__(self, tenant):
+        """
+        Return the database of a tenant.
+
+        :param tenant: The tenant name.
+        :return: The couchdbkit database or None if it does not exist.
+        """
+        name = self.name_format % tenant
+        if name not in self.server:
+            return None
+        return self.server.get_db(name)
+
+
+@implementer(IIdentifier)
+class TenantIdentifier:
+
+    """
+    Binds an identifier shared by all tenants to a single tenant. Users are
+    remembered as tenant:username and identities remembered for any other
+    tenant are rejected, so a user logged in to one tenant is not logged in
+    to every tenant with the same username.
+    """
+
+    def __init__(self, identifier, tenant):
+        """
+        Create a new tenant identifier.
+
+        :param identifier: The shared identifier, such as an
+            AuthTktIdentifier.
+        :param tenant: The tenant name.
+        """
+        self.identifier = identifier
+        self.tenant = tenant
+
+    def identify(self, request):
+        """
+        Return the username of the remembered user if it was remembered for
+        this tenant.
+
+        :param request: The WSGI request.
+        :return: The username or None.
+        """
+        userid = self.identifier.identify(request)
+        if userid is None:
+            return None
+        tenant, sep, username = userid.partition(':')
+        if not sep or tenant != self.tenant:
+            return None
+        return username
+
+    def remember(self, request, username, **kw):
+        """
+        Return the headers necessary for remembering the user in this tenant.
+
+        :param request: The WSGI request.
+        :param username: The username to remember.
+        :param kw: Additional identifier parameters.
+        :return: A list of headers to add to the response.
+        """
+        return self.identifier.remember(request,
+            '%s:%s' % (self.tenant, username), **kw)
+
+    def forget(self, request):
+        """
+        Return the headers necessary for forgetting any remembered user.
+
+        :param request: The WSGI request.
+        :return: A list of headers to add to the response.
+        """
+        return self.identifier.forget(request)
+
+
+class TenantRegistry:
+
+    """
+    Holds an authentication and authorization policy pair for each active
+    tenant, created by a policy factory from the tenant's database. Tenants
+    which have not been used for idle_ttl seconds are evicted along with
+    their policies and caches, and at most max_tenants are kept, so memory
+    stays bounded however many tenants exist.
+
+    Tenant names come from the request, so they are checked before a
+    database is opened. Names which do not match the pattern, are not in the
+    allowed set or have no database are unknown. Requests for unknown tenants
+    get no policies. Unknown tenants are remembered separately from the
+    active tenants so requests for random names cannot evict them.
+    """
+
+    def __init__(self, resolver, database_factory, policy_factory,
+            max_tenants=1000, idle_ttl=600, allowed=None,
+            pattern=TENANT_PATTERN, max_unknown=1000, unknown_ttl=60):
+        """
+        Create a new tenant registry.
+
+        :param resolver: A callable returning the tenant of a request or None.
+        :param database_factory: A callable returning the database of a
+            tenant. See ServerDatabaseFactory.
+        :param policy_factory: A callable taking the tenant name and its
+            database which returns a tuple of the tenant's
+            CouchAuthenticationPolicy and CouchAuthorizationPolicy. An
+            identifier shared by all tenants must be bound to the tenant with
+            a TenantIdentifier.
+        :param max_tenants: The maximum number of tenants to hold.
+        :param idle_ttl: The number of seconds an unused tenant is kept.
+        :param allowed: An optional collection of tenant names. A None value
+            allows any name matching the pattern.
+        :param pattern: A regular expression tenant names must match. The
+            default refuses CouchDB system databases such as _users.
+        :param max_unknown: The maximum number of unknown tenants to
+            remember.
+        :param unknown_ttl: The number of seconds an unknown tenant is
+            remembered before its database is checked again.
+        """
+        self.resolver = resolver
+        self.database_factory = database_factory
+        self.policy_factory = policy_factory
+        self.allowed = allowed
+        self.pattern = re.compile(pattern)
+        self.tenants = TTLCache(max_tenants, idle_ttl, sliding=True)
+        self.unknown = TTLCache(max_unknown, unknown_ttl)
+
+    def _create(self, tenant):
+        """
+        Create the policies of a tenant.
+
+        :param tenant: The tenant name.
+        :return: A tuple of the authentication and authorization policies, or
+            None if the tenant has no database.
+        """
+        database = self.database_factory(tenant)
+        if database is None:
+            return None
+        return self.policy_factory(tenant, database)
+
+    def policies(self, request):
+        """
+        Return the policies of the tenant a request belongs to.
+
+        :param request: The WSGI request.
+        :return: A tuple of the authentication and authorization policies.
+            Both are None if the request has no tenant or an unknown one.
+        """
+        tenant = None
+        if request is not None:
+            tenant = self.resolver(request)
+        if tenant is None or not self.valid(tenant) or tenant in self.unknown:
+            return None, None
+        policies = self.tenants.get(tenant)
+        if policies is None:
+            policies = self._create(tenant)
+            if policies is None:
+                self.unknown.set(tenant, True)
+                return None, None
+            self.tenants.set(tenant, policies)
+        return policies
+
+    def valid(self, tenant):
+        """
+        Check a tenant name before its database is opened.
+
+        :param tenant: The tenant name.
+        :return: True if the name matches the pattern and is allowed.
+        """
+        if self.pattern.match(tenant) is None:
+            return False
+        return self.allowed is None or tenant in self.allowed
+
+
+@implementer(IAuthenticationPolicy)
+class TenantAuthenticationPolicy:
+
+    """
+    Authentication policy which delegates to the CouchAuthenticationPolicy
+    of the request's tenant. Requests without a tenant are unauthenticated.
+    """
+
+    def __init__(self, registry):
+        """
+        Create a new tenant authentication policy.
+
+        :param registry: The TenantRegistry holding the tenant policies.
+        """
+        self.registry = registry
+
+    def unauthenticated_userid(self, request):
+        """
+        Retrieve an unauthenticated username remembered for the tenant.
+        :param request: The WSGI request.
+        :return: The unauthenticated username or None if no user is present.
+        """
+        policy = self.registry.policies(request)[0]
+        if policy is None:
+            return None
+        return policy.unauthenticated_userid(request)
+
+    def authenticated_userid(self, request):
+        """
+        Retrieve the authenticated user ID from the tenant database.
+        :param request: The WSGI request.
+        :return: The username of the authenticated user or None if no user is
+            authenticated.
+        """
+        policy = self.registry.policies(request)[0]
+        if policy is None:
+            return None
+        return policy.authenticated_userid(request)
+
+    def effective_principals(self, request):
+        """
+        Retrieve the effective principals from the tenant database.
+        :param request: The WSGI request.
+        :return: A LazyPrincipals sequence.
+        """
+        policy = self.registry.policies(request)[0]
+        if policy is None:
+            return LazyPrincipals(None, request, None)
+        return policy.effective_principals(request)
+
+    def remember(self, request, principal, **kw):
+        """
+        Return a set of headers suitable for "remembering" the given principal.
+        :param request: The WSGI request.
+        :param principal: The principal to remember.
+        :param kw: Additional parameters.
+        :return: A list of headers.
+        """
+        policy = self.registry.policies(request)[0]
+        if policy is None:
+            return []
+        return policy.remember(request, principal, **kw)
+
+    def forget(self, request):
+        """
+        Return a set of headers suitable for "forgetting" the current user
+        principal.
+        :param request: The WSGI request.
+        :return: A list of headers.
+        """
+        policy = self.registry.policies(request)[0]
+        if policy is None:
+            return []
+        return policy.forget(request)
+
+
+@implementer(IAuthorizationPolicy)
+class TenantAuthorizationPolicy:
+
+    """
+    Authorization policy which delegates to the CouchAuthorizationPolicy of
+    the current request's tenant. Nothing is permitted without a tenant.
+    """
+
+    def __init__(self, registry):
+        """
+        Create a new tenant authorization policy.
+
+        :param registry: The TenantRegistry holding the tenant policies.
+        """
+        self.registry = registry
+
+    def permits(self, context, principals, permission):
+        """
+        Return True if any of the principals have the provided permission in
+        the current tenant.
+        :param context: The context in which permission checking is occuring.
+        :param principals: The list of principals to check.
+        :param permission: The permission to check the principals for.
+        :return: True if one of the principals has the permission, false
+            otherwise.
+        """
+        policy = self.registry.policies(get_current_request())[1]
+        if policy is None:
+            return False
+        return policy.permits(context, principals, permission)
+
+    def principals_allowed_by_permission(self, context, permission):
+        """
+        Return a list of principals who have the provided permission in the
+        current tenant.
+        :param context: The context in which permission checking is occuring.
+        :param permission: The permission to retrieve principals for.
+        :return: A list of principals which contain the given permission.
+        """
+        policy = self.registry.policies(get_current_request())[1]
+        if policy is None:
+            return []
+        return policy.principals_allowed_by_permission(context, permission)
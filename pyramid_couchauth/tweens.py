@@ -0,0 +1,123 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Tweens for profiling auth/auth in a running application.
+"""
+
+import logging
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+TIMINGS_KEY = 'couchauth.timings'
+
+
+class AuthTimings:
+
+    """
+    Accumulates the time spent in each auth step over a single request.
+    Steps may nest, as when lazy principals are expanded while permits runs.
+    A step's time excludes the time of steps nested inside it, so each moment
+    is counted once and total is the real time spent in auth.
+    """
+
+    def __init__(self, clock=timeit.default_timer):
+        """
+        Create an empty set of timings.
+
+        :param clock: A callable returning the current time in seconds.
+        """
+        self.clock = clock
+        self.durations = OrderedDict()
+        self.nested = []
+
+    def add(self, name, seconds):
+        """
+        Add time to an auth step.
+
+        :param name: The name of the step.
+        :param seconds: The number of seconds spent in the step.
+        """
+        self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def total(self):
+        """
+        Return the total time spent in auth steps in seconds.
+        """
+        return sum(self.durations.values())
+
+    def header(self):
+        """
+        Format the timings as the value of a Server-Timing header. Durations
+        are given in milliseconds.
+        """
+        return ', '.join('couchauth-%s;dur=%.3f' % (name, seconds * 1000)
+            for name, seconds in self.durations.items())
+
+    def __len__(self):
+        """Return the number of steps timed."""
+        return len(self.durations)
+
+
+@contextmanager
+def timed(request, name):
+    """
+    Time the enclosed block as an auth step of the given request. Time spent
+    in steps nested inside the block is left to those steps. Does nothing if
+    the request is not being timed.
+
+    :param request: The request being processed. May be None.
+    :param name: The name of the auth step.
+    """
+    timings = None
+    if request is not None:
+        timings = request.environ.get(TIMINGS_KEY)
+    if timings is None:
+        yield
+        return
+    timings.nested.append(0)
+    start = timings.clock()
+    try:
+        yield
+    finally:
+        elapsed = timings.clock() - start
+        timings.add(name, elapsed - timings.nested.pop())
+        if timings.nested:
+            timings.nested[-1] += elapsed
+
+
+def timing_tween_factory(handler, registry):
+    """
+    Create a tween which measures the time spent identifying users, expanding
+    their principals and checking permissions. The breakdown is added to the
+    response as a Server-Timing header.
+
+    Settings:
+      couchauth.slow_threshold -- Log a warning for requests which spend more
+        than this many milliseconds in auth steps. Disabled by default.
+
+    :param handler: The downstream handler.
+    :param registry: The application registry.
+    :return: The tween.
+    """
+    settings = registry.settings or {}
+    threshold = settings.get('couchauth.slow_threshold')
+    if threshold is not None:
+        threshold = float(threshold) / 1000
+
+    def timing_tween(request):
+        timings = AuthTimings()
+        request.environ[TIMINGS_KEY] = timings
+        response = handler(request)
+        if len(timings) > 0:
+            response.headers.add('Server-Timing', timings.header())
+            if threshold is not None and timings.total() > threshold:
+                log.warning('slow auth for %s %s: %s', request.method,
+                    request.path, timings.header())
+        return response
+
+    return timing_tween
@@ -16,14 +16,29 @@ class DummyDatabase:
         """Initialize the object."""
         self.data = data
         self.views = {}
+        self.queries = 0
+        self.docs = []
 
     def add_view(self, name, data):
         """Add view data to the dummy database."""
         self.views[name] = data
 
-    def view(self, name, key):
-        """Get a value out of a view."""
-        if name not in self.views or key not in self.views[name]:
+    def view(self, name, key=None, keys=None):
+        """
+        Get values out of a view. Returns the rows of key, or of each of keys
+        in order, or all rows if neither is given.
+        """
+        self.queries += 1
+        if name not in self.views:
             return []
-        return [{'value': v} for v in self.views[name][key]]
+        if key is not None:
+            keys = [key]
+        elif keys is None:
+            keys = sorted(self.views[name])
+        return [{'id': k, 'key': k, 'value': v}
+            for k in keys for v in self.views[name].get(k, [])]
 
+    def bulk_save(self, docs):
+        """Save documents to the dummy database."""
+        self.queries += 1
+        self.docs.extend(docs)
@@ -0,0 +1,372 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+End-to-end load test for the couchauth policies.
+
+Runs a fake CouchDB HTTP server which serves the auth views from generated
+data, puts a sample Pyramid application configured through
+pyramid_couchauth.configure in front of it and drives the application with
+concurrent clients. Unlike the unit tests this exercises couchdbkit's HTTP
+client, JSON parsing and connection pooling.
+
+Usage:
+    python -m tests.loadtest [--clients 16] [--requests 2000] [--latency 2]
+        [--users 1000] [--groups 50] [--unknown 0.1] [--mode plain ...]
+"""
+
+import json
+import optparse
+import random
+import re
+import threading
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+MODES = {
+    'plain': {},
+    'cached': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60'},
+    'refresh': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.refresh_ahead': 'true'},
+    'filter': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.user_filter': 'true'},
+    'decision': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.decision_cache_size': '10000'},
+    'hierarchical': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.hierarchical': 'true'},
+    'audit': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.audit': 'true'},
+    'security': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.security_policy': 'true'},
+    'prefetch': {
+        'couchauth.cache_size': '10000',
+        'couchauth.cache_ttl': '60',
+        'couchauth.security_policy': 'true',
+        'couchauth.prefetch_permissions': 'true'},
+}
+
+
+def generate_views(users, groups):
+    """
+    Generate auth view data. Every user belongs to two groups and every
+    second group is granted the read permission.
+
+    :param users: The number of users to generate.
+    :param groups: The number of groups to generate.
+    :return: A dict mapping view names to dicts of keys to lists of values.
+    """
+    views = {
+        'user_names': {},
+        'user_groups': {},
+        'group_perms': {},
+        'perm_groups': {'read': []}}
+    for i in range(users):
+        name = 'user%i' % i
+        views['user_names'][name] = [name]
+        views['user_groups'][name] = ['group%i' % (i % groups),
+            'group%i' % ((i * 7) % groups)]
+    for i in range(groups):
+        name = 'group%i' % i
+        perms = ['perm%i' % j for j in range(5)]
+        if i % 2 == 0:
+            perms.append('read')
+            views['perm_groups']['read'].append(name)
+        views['group_perms'][name] = perms
+    return views
+
+
+class FakeCouchHandler(BaseHTTPRequestHandler):
+
+    """
+    Serve a database and its design document views the way CouchDB does.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    view_path = re.compile('^/([^/]+)/_design/([^/]+)/_view/([^/]+)$')
+
+    def log_message(self, format, *args):
+        """Silence request logging."""
+
+    def send_json(self, status, body):
+        """Send a JSON response."""
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        """Answer database existence checks."""
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        """Serve database info, the _changes feed and view queries."""
+        url = urlparse(self.path)
+        if url.path.endswith('/_changes'):
+            timeout = parse_qs(url.query).get('timeout', ['0'])[0]
+            threading.Event().wait(float(timeout) / 1000)
+            self.send_json(200, {'results': [], 'last_seq': 0})
+            return
+        match = self.view_path.match(url.path)
+        if match is None:
+            self.send_json(200, {'db_name': url.path.strip('/'),
+                'doc_count': 0, 'update_seq': 0})
+            return
+        query = parse_qs(url.query)
+        keys = None
+        if 'key' in query:
+            keys = [json.loads(query['key'][0])]
+        self.send_view(match.group(3), keys)
+
+    def do_POST(self):
+        """Serve multi-key view queries and accept _bulk_docs writes."""
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        match = self.view_path.match(urlparse(self.path).path)
+        if match is not None:
+            self.send_view(match.group(3), body.get('keys', []))
+            return
+        self.server.count_query()
+        self.server.delay()
+        self.send_json(201, [{'ok': True, 'id': str(i), 'rev': '1-0'}
+            for i, _ in enumerate(body.get('docs', []))])
+
+    def send_view(self, name, keys):
+        """
+        Send the rows of a view.
+
+        :param name: The name of the view.
+        :param keys: The keys to send rows for, or None for all rows.
+        """
+        server = self.server
+        server.count_query()
+        server.delay()
+        rows = server.views.get(name)
+        if rows is None:
+            self.send_json(404, {'error': 'not_found',
+                'reason': 'missing_named_view'})
+            return
+        if keys is None:
+            keys = sorted(rows)
+        result = [{'id': k, 'key': k, 'value': v}
+            for k in keys for v in rows.get(k, [])]
+        self.send_json(200, {'total_rows': len(result), 'offset': 0,
+            'rows': result})
+
+
+class FakeCouchServer(ThreadingMixIn, HTTPServer):
+
+    """
+    A threaded fake CouchDB server with configurable latency which counts the
+    queries it serves.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, views, latency=0, address=('127.0.0.1', 0)):
+        """
+        Create the server.
+
+        :param views: View data as returned by generate_views.
+        :param latency: Seconds to wait before answering each query.
+        :param address: The address to bind to. Port 0 picks a free port.
+        """
+        HTTPServer.__init__(self, address, FakeCouchHandler)
+        self.views = views
+        self.latency = latency
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    @property
+    def uri(self):
+        """The base URI of the server."""
+        return 'http://%s:%i/' % self.server_address
+
+    def count_query(self):
+        """Count a query."""
+        with self.lock:
+            self.queries += 1
+
+    def delay(self):
+        """Simulate network and database latency."""
+        if self.latency > 0:
+            threading.Event().wait(self.latency)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def make_app(database, settings):
+    """
+    Create a sample application with one view protected by the read
+    permission.
+
+    :param database: The couchdbkit database holding the auth views.
+    :param settings: The application settings.
+    :return: The WSGI application.
+    """
+    from pyramid.config import Configurator
+    from pyramid.response import Response
+    from pyramid_couchauth import configure
+
+    config = Configurator(settings=settings)
+    configure(config, database)
+    config.add_route('item', '/items/{id}')
+    config.add_view(lambda request: Response('ok'), route_name='item',
+        permission='read')
+    return config.make_wsgi_app()
+
+
+def make_cookies(secret, usernames):
+    """
+    Create auth_tkt cookie values for the given users.
+
+    :param secret: The secret used by the application.
+    :param usernames: The usernames to create cookies for.
+    :return: A list of cookie values.
+    """
+    from pyramid.testing import DummyRequest
+    from pyramid_couchauth.identification import AuthTktIdentifier
+
+    identifier = AuthTktIdentifier(secret)
+    request = DummyRequest()
+    cookies = []
+    for username in usernames:
+        headers = identifier.remember(request, username)
+        name = headers[0][0]
+        cookies.append(re.sub(';.*', '',
+            headers[0][1][len(name) - 1:]).strip('"'))
+    return cookies
+
+
+def percentile(values, fraction):
+    """Return the given percentile of a sorted list of values."""
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
+
+
+def run(mode, server, cookies, clients, requests):
+    """
+    Drive the sample application with concurrent clients.
+
+    :param mode: The name of the policy mode from MODES.
+    :param server: The running FakeCouchServer.
+    :param cookies: The auth_tkt cookie values to pick from.
+    :param clients: The number of concurrent clients.
+    :param requests: The total number of requests to send.
+    :return: A dict of results.
+    """
+    from couchdbkit import Server
+    from webob import Request
+
+    settings = {'couchauth.secret': 'loadtest'}
+    settings.update(MODES[mode])
+    database = Server(server.uri).get_db('auth')
+    app = make_app(database, settings)
+
+    latencies = []
+    lock = threading.Lock()
+    per_client = requests // clients
+
+    def client(seed):
+        rng = random.Random(seed)
+        results = []
+        for i in range(per_client):
+            request = Request.blank('/items/%i' % i)
+            request.cookies['auth_tkt'] = rng.choice(cookies)
+            start = timeit.default_timer()
+            request.get_response(app)
+            results.append(timeit.default_timer() - start)
+        with lock:
+            latencies.extend(results)
+
+    queries = server.queries
+    threads = [threading.Thread(target=client, args=(seed,))
+        for seed in range(clients)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - start
+
+    latencies.sort()
+    total = len(latencies)
+    return {
+        'mode': mode,
+        'requests': total,
+        'throughput': total / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p90': percentile(latencies, 0.90) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'queries': float(server.queries - queries) / total}
+
+
+def main(argv=None):
+    """Run the load test and print a report."""
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--clients', type='int', default=16,
+        help='number of concurrent clients')
+    parser.add_option('--requests', type='int', default=2000,
+        help='total number of requests per mode')
+    parser.add_option('--latency', type='float', default=2,
+        help='fake CouchDB latency in milliseconds')
+    parser.add_option('--users', type='int', default=1000,
+        help='number of generated users')
+    parser.add_option('--groups', type='int', default=50,
+        help='number of generated groups')
+    parser.add_option('--unknown', type='float', default=0.1,
+        help='fraction of requests for users that do not exist')
+    parser.add_option('--mode', action='append', choices=sorted(MODES),
+        help='policy mode to run, may be repeated (default: all)')
+    options, _ = parser.parse_args(argv)
+
+    server = FakeCouchServer(generate_views(options.users, options.groups),
+        options.latency / 1000)
+    server.start()
+
+    usernames = ['user%i' % i for i in range(options.users)]
+    unknown = int(len(usernames) * options.unknown / (1 - options.unknown))
+    usernames.extend('bot%i' % i for i in range(unknown))
+    cookies = make_cookies('loadtest', usernames)
+
+    print('%-12s %9s %10s %8s %8s %8s %9s' % ('mode', 'requests', 'req/s',
+        'p50 ms', 'p90 ms', 'p99 ms', 'queries'))
+    for mode in options.mode or sorted(MODES):
+        result = run(mode, server, cookies, options.clients, options.requests)
+        print('%(mode)-12s %(requests)9i %(throughput)10.1f %(p50)8.2f '
+            '%(p90)8.2f %(p99)8.2f %(queries)9.2f' % result)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
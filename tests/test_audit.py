@@ -0,0 +1,110 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the audit module.
+"""
+
+import atexit
+import unittest
+from pyramid.config import Configurator
+from pyramid_couchauth import configure
+from pyramid_couchauth.audit import AuditLog
+from tests.couch import DummyDatabase
+
+
+class FailingDatabase(DummyDatabase):
+
+    """A database which fails every write."""
+
+    def bulk_save(self, docs):
+        """Fail to save documents."""
+        raise IOError('database unavailable')
+
+
+class TestAuditLog(unittest.TestCase):
+
+    """Test the AuditLog class."""
+
+    def setUp(self):
+        """Create an audit log."""
+        self.database = DummyDatabase({})
+        self.audit = AuditLog(self.database, max_queue=4, batch_size=3,
+            clock=lambda: 1000)
+
+    def test_record(self):
+        """Verify records are queued as audit documents."""
+        self.assertTrue(self.audit.record('permits', permission='view'))
+        self.assertEqual(self.audit.queue.get_nowait(), {'type': 'audit',
+            'event': 'permits', 'time': 1000, 'permission': 'view'})
+
+    def test_flush(self):
+        """Verify flush writes records in batches."""
+        for i in range(4):
+            self.audit.record('permits')
+        self.assertEqual(self.audit.flush(), 4, 'flush count invalid')
+        self.assertEqual(len(self.database.docs), 4, 'records not written')
+        self.assertEqual(self.database.queries, 2, 'records not batched')
+
+    def test_dropped(self):
+        """Verify records beyond the queue size are dropped and counted."""
+        for i in range(6):
+            self.audit.record('permits')
+        self.assertEqual(self.audit.dropped, 2, 'dropped count invalid')
+
+    def test_sampled(self):
+        """Verify records are sampled once the queue is nearly full."""
+        audit = AuditLog(self.database, max_queue=4, sample_rate=0,
+            sample_threshold=0.5)
+        for i in range(4):
+            audit.record('permits')
+        self.assertEqual(audit.queue.qsize(), 2, 'queue not sampled')
+        self.assertEqual(audit.sampled, 2, 'sampled count invalid')
+        self.assertEqual(audit.dropped, 0, 'sampled records dropped')
+
+    def test_failed(self):
+        """Verify failed writes are counted."""
+        audit = AuditLog(FailingDatabase({}))
+        audit.record('permits')
+        audit.flush()
+        self.assertEqual(audit.failed, 1, 'failed count invalid')
+
+    def test_writer(self):
+        """Verify the writer thread writes queued records."""
+        audit = AuditLog(self.database, flush_interval=0.01)
+        audit.start()
+        try:
+            audit.record('permits')
+            audit.record('forget')
+        finally:
+            audit.stop()
+        events = [doc['event'] for doc in self.database.docs]
+        self.assertEqual(events, ['permits', 'forget'], 'records not written')
+
+
+class TestConfigureAudit(unittest.TestCase):
+
+    """Test the audit log set up by configure."""
+
+    def setUp(self):
+        """Capture exit handlers instead of registering them."""
+        self.handlers = []
+        self.register = atexit.register
+        atexit.register = self.handlers.append
+
+    def tearDown(self):
+        """Restore exit handler registration."""
+        atexit.register = self.register
+
+    def test_exit(self):
+        """Verify queued records are written at exit."""
+        database = DummyDatabase({})
+        config = Configurator(settings={'couchauth.audit': 'true',
+            'couchauth.audit_flush_interval': '60'})
+        configure(config, database)
+        audit = self.handlers[0].__self__
+        audit.record('permits')
+        for handler in self.handlers:
+            handler()
+        self.assertEqual(len(database.docs), 1, 'queued record lost at exit')
@@ -0,0 +1,101 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the bloom module.
+"""
+
+import unittest
+from pyramid_couchauth.bloom import BloomFilter, UserNameFilter
+from tests.couch import DummyDatabase
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    """Test the BloomFilter class."""
+
+    def test_size(self):
+        """Verify the filter is sized from capacity and error rate."""
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.num_bits, 9586, 'bit count invalid')
+        self.assertEqual(bloom.num_hashes, 7, 'hash count invalid')
+        self.assertEqual(bloom.size_bytes, 1199, 'byte size invalid')
+
+    def test_members(self):
+        """Verify added items are always found."""
+        bloom = BloomFilter(1000, 0.01)
+        names = ['user%i' % i for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+        for name in names:
+            self.assertTrue(name in bloom, 'false negative for %s' % name)
+        self.assertEqual(bloom.count, 1000, 'item count invalid')
+
+    def test_error_rate(self):
+        """Verify the false positive rate is near the configured rate."""
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user%i' % i)
+        hits = sum(1 for i in range(10000) if 'bot%i' % i in bloom)
+        self.assertTrue(hits < 300, 'false positive rate too high')
+
+
+class TestUserNameFilter(unittest.TestCase):
+
+    """Test the UserNameFilter class."""
+
+    def setUp(self):
+        """Set up a database of users."""
+        self.database = DummyDatabase({})
+        self.database.add_view('pyramid/user_names', {
+            'admin': ['admin'], 'guest': ['guest']})
+        self.filter = UserNameFilter(self.database)
+
+    def test_might_exist(self):
+        """Verify known users pass and the filter is built once."""
+        self.assertTrue(self.filter.might_exist('admin'), 'admin rejected')
+        self.assertTrue(self.filter.might_exist('guest'), 'guest rejected')
+        self.assertEqual(self.database.queries, 1, 'filter built twice')
+        self.assertTrue(self.filter.size_bytes > 0, 'size not reported')
+        self.assertTrue(self.filter.build_time is not None,
+            'build time not reported')
+
+    def test_add(self):
+        """Verify added users pass before the next rebuild."""
+        self.filter.rebuild()
+        self.filter.add('newbie')
+        self.assertTrue(self.filter.might_exist('newbie'), 'new user rejected')
+
+    def test_rebuild(self):
+        """Verify a rebuild picks up new users."""
+        self.filter.rebuild()
+        self.database.views['pyramid/user_names']['newbie'] = ['newbie']
+        self.filter.rebuild()
+        self.assertTrue(self.filter.might_exist('newbie'), 'new user rejected')
+
+    def test_add_during_rebuild(self):
+        """Verify users added while the view is read survive the rebuild."""
+        self.filter.rebuild()
+        view = self.database.view
+
+        def adding_view(name, key=None):
+            self.filter.add('newbie')
+            return view(name, key)
+        self.database.view = adding_view
+        self.filter.rebuild()
+        self.assertTrue(self.filter.might_exist('newbie'), 'new user lost')
+
+    def test_changes(self):
+        """Verify changes to the user names view trigger a rebuild."""
+        responses = [{'results': [], 'last_seq': 1},
+            {'results': [{'seq': 2, 'id': 'newbie'}], 'last_seq': 2}]
+        self.filter.changes._changes = lambda since: responses.pop(0)
+        self.filter.changes.since = 0
+        self.filter.rebuild()
+        self.database.views['pyramid/user_names']['newbie'] = ['newbie']
+        self.assertFalse(self.filter.changes.poll(), 'rebuilt without changes')
+        self.assertFalse(self.filter.might_exist('newbie'),
+            'rebuilt without changes')
+        self.assertTrue(self.filter.changes.poll(), 'changes ignored')
+        self.assertTrue(self.filter.might_exist('newbie'), 'new user rejected')
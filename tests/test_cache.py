@@ -0,0 +1,164 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the cache module.
+"""
+
+import unittest
+from pyramid_couchauth.cache import RateLimiter, RefreshAheadCache, TTLCache
+
+
+class DummyClock:
+
+    """A clock which only moves when told to."""
+
+    def __init__(self):
+        """Initialize the clock."""
+        self.now = 1000.0
+
+    def __call__(self):
+        """Return the current time."""
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    """Test the TTLCache class."""
+
+    def setUp(self):
+        """Create a cache with a controllable clock."""
+        self.clock = DummyClock()
+        self.cache = TTLCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_get_set(self):
+        """Verify stored values are returned."""
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1, 'cached value invalid')
+        self.assertEqual(self.cache.get('b', 2), 2, 'default value invalid')
+
+    def test_expire(self):
+        """Verify values expire after the ttl."""
+        self.cache.set('a', 1)
+        self.clock.now += 10
+        self.assertTrue(self.cache.get('a') is None, 'value did not expire')
+        self.assertEqual(len(self.cache), 0, 'expired value not purged')
+
+    def test_sliding(self):
+        """Verify a sliding cache extends entries when they are used."""
+        cache = TTLCache(ttl=10, clock=self.clock, sliding=True)
+        cache.set('a', 1)
+        self.clock.now += 8
+        self.assertEqual(cache.get('a'), 1, 'value expired early')
+        self.clock.now += 8
+        self.assertEqual(cache.get('a'), 1, 'value not extended')
+        self.clock.now += 10
+        self.assertTrue(cache.get('a') is None, 'idle value did not expire')
+
+    def test_evict(self):
+        """Verify the least recently used value is evicted."""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertTrue('a' in self.cache, 'recently used value evicted')
+        self.assertFalse('b' in self.cache, 'least recently used value kept')
+        self.assertTrue('c' in self.cache, 'new value evicted')
+
+    def test_fetch(self):
+        """Verify fetch only calls the loader on a miss."""
+        calls = []
+        loader = lambda: calls.append(1) or 'value'
+        self.assertEqual(self.cache.fetch('a', loader), 'value')
+        self.assertEqual(self.cache.fetch('a', loader), 'value')
+        self.assertEqual(len(calls), 1, 'loader called on a hit')
+
+    def test_invalidate(self):
+        """Verify invalidate and clear remove values."""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate('a')
+        self.assertFalse('a' in self.cache, 'invalidated value kept')
+        self.cache.set('c', 3)
+        self.cache.invalidate_matching(lambda key: key == 'c')
+        self.assertTrue('b' in self.cache, 'unmatched value invalidated')
+        self.assertFalse('c' in self.cache, 'matched value kept')
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0, 'cleared cache not empty')
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    """Test the RateLimiter class."""
+
+    def test_acquire(self):
+        """Verify acquire waits once the burst is exhausted."""
+        clock = DummyClock()
+        waits = []
+        limiter = RateLimiter(10, burst=2, clock=clock, sleep=waits.append)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(waits, [], 'burst was rate limited')
+        limiter.acquire()
+        self.assertEqual(len(waits), 1, 'rate was not limited')
+        self.assertAlmostEqual(waits[0], 0.1)
+
+
+class TestRefreshAheadCache(unittest.TestCase):
+
+    """Test the RefreshAheadCache class."""
+
+    def setUp(self):
+        """Create a cache with a controllable clock."""
+        self.clock = DummyClock()
+        self.cache = RefreshAheadCache(ttl=10, refresh_window=2, min_hits=2,
+            clock=self.clock)
+        self.loads = {}
+
+    def loader(self, key):
+        """Return a loader which counts its calls."""
+        def load():
+            self.loads[key] = self.loads.get(key, 0) + 1
+            return '%s%i' % (key, self.loads[key])
+        return load
+
+    def test_scan(self):
+        """Verify only expiring entries in demand are queued."""
+        self.cache.fetch('hot', self.loader('hot'))
+        self.cache.fetch('cold', self.loader('cold'))
+        self.cache.fetch('hot', self.loader('hot'))
+        self.cache.fetch('hot', self.loader('hot'))
+        self.assertEqual(self.cache.scan(), [], 'fresh entries queued')
+        self.clock.now += 9
+        self.assertEqual(self.cache.scan(), ['hot'],
+            'refresh candidates invalid')
+        self.assertEqual(self.cache.scan(), [], 'pending entry queued twice')
+
+    def test_refresh(self):
+        """Verify refresh reloads the entry and resets its hits."""
+        self.cache.fetch('hot', self.loader('hot'))
+        self.cache.get('hot')
+        self.cache.get('hot')
+        self.clock.now += 9
+        self.cache.refresh('hot')
+        self.assertEqual(self.loads['hot'], 2, 'entry not reloaded')
+        self.clock.now += 9
+        self.assertEqual(self.cache.get('hot'), 'hot2', 'entry not extended')
+        self.assertEqual(self.cache.scan(), [], 'hits not reset')
+
+    def test_workers(self):
+        """Verify the worker pool reloads queued entries."""
+        self.cache.fetch('hot', self.loader('hot'))
+        self.cache.get('hot')
+        self.cache.get('hot')
+        self.clock.now += 9
+        self.cache.start()
+        try:
+            self.cache.scan()
+            self.cache.queue.join()
+        finally:
+            self.cache.stop()
+        self.assertEqual(self.loads['hot'], 2, 'worker did not reload entry')
+        self.assertEqual(self.cache.get('hot'), 'hot2',
+            'worker did not store entry')
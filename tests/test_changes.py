@@ -0,0 +1,40 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the changes module.
+"""
+
+import unittest
+from pyramid_couchauth.changes import ChangesFollower
+from tests.couch import DummyDatabase
+
+
+class TestChangesFollower(unittest.TestCase):
+
+    """Test the ChangesFollower class."""
+
+    def setUp(self):
+        """Create a follower with canned _changes responses."""
+        self.changed = []
+        self.follower = ChangesFollower(DummyDatabase({}), 'pyramid/view',
+            self.changed.extend)
+        self.follower._update_seq = lambda: 5
+        self.responses = [{'results': [], 'last_seq': 5},
+            {'results': [{'seq': 6, 'id': 'a'}, {'seq': 7, 'id': 'b'}],
+                'last_seq': 7}]
+        self.requested = []
+
+        def changes(since):
+            self.requested.append(since)
+            return self.responses.pop(0)
+        self.follower._changes = changes
+
+    def test_poll(self):
+        """Verify changed ids are passed on and the sequence advances."""
+        self.assertFalse(self.follower.poll(), 'empty poll reported changes')
+        self.assertTrue(self.follower.poll(), 'changes not reported')
+        self.assertEqual(self.changed, ['a', 'b'], 'changed ids invalid')
+        self.assertEqual(self.requested, [5, 5], 'sequences invalid')
+        self.assertEqual(self.follower.since, 7, 'sequence not advanced')
@@ -11,7 +11,9 @@ import unittest
 from pyramid import testing
 from pyramid import authentication as auth
 from pyramid_couchauth.interfaces import IIdentifier
-from pyramid_couchauth.identification import AuthTktIdentifier
+from pyramid_couchauth.identification import (AuthTktIdentifier,
+    BearerTokenIdentifier, hash_token)
+from tests.couch import DummyDatabase
 
 
 class TestAuthTktIdentifier(unittest.TestCase):
@@ -109,3 +111,106 @@ class TestAuthTktIdentifier(unittest.TestCase):
             self.assertTrue(header_value.match(header[1]),
                 'forget header value invalid')
 
+
+class TestBearerTokenIdentifier(unittest.TestCase):
+
+    """Test the BearerTokenIdentifier class."""
+
+    def setUp(self):
+        """Set up a database of token hashes."""
+        self.token = 's3cr3t-t0k3n'
+        self.database = DummyDatabase({})
+        self.database.add_view('pyramid/token_hashes', {
+            hash_token(self.token): ['robot']})
+        self.identifier = BearerTokenIdentifier(self.database)
+
+    def request(self, authorization=None):
+        """Create a request with the given Authorization header."""
+        request = testing.DummyRequest()
+        if authorization is not None:
+            request.headers['Authorization'] = authorization
+        return request
+
+    def test_interface(self):
+        """Verify BearerTokenIdentifier implements the identifier interface."""
+        self.assertTrue(IIdentifier.implementedBy(BearerTokenIdentifier))
+
+    def test_hash_token(self):
+        """Verify tokens are hashed with SHA-256."""
+        self.assertEqual(hash_token('abc'),
+            'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad',
+            'token hash invalid')
+
+    def test_identify_absent(self):
+        """Verify return of identify when no token is present."""
+        self.assertEqual(self.identifier.identify(self.request()), None,
+            'identification found without a token')
+        self.assertEqual(self.identifier.identify(self.request('Basic abc')),
+            None, 'identification found for another scheme')
+        self.assertEqual(self.database.queries, 0,
+            'missing token queried the database')
+
+    def test_identify_present(self):
+        """Verify return of identify when a known token is present."""
+        request = self.request('Bearer %s' % self.token)
+        self.assertEqual(self.identifier.identify(request), 'robot',
+            'unable to identify token')
+        self.assertEqual(self.identifier.identify(request), 'robot',
+            'unable to identify cached token')
+        self.assertEqual(self.database.queries, 1, 'token lookup not cached')
+
+    def test_identify_unknown(self):
+        """Verify unknown tokens are cached for the negative ttl."""
+        request = self.request('Bearer forged')
+        self.assertEqual(self.identifier.identify(request), None,
+            'forged token identified')
+        self.identifier.identify(request)
+        self.assertEqual(self.database.queries, 1, 'unknown token not cached')
+        self.assertFalse(hash_token('forged') in self.identifier.cache,
+            'unknown token cached with known tokens')
+        entry = self.identifier.negative_cache.entries[hash_token('forged')]
+        self.assertTrue(entry[1] - self.identifier.negative_cache.clock() <= 5,
+            'unknown token cached for too long')
+
+    def test_revoke(self):
+        """Verify revoke evicts the token from the cache."""
+        request = self.request('Bearer %s' % self.token)
+        self.identifier.identify(request)
+        del self.database.views['pyramid/token_hashes'][hash_token(self.token)]
+        self.identifier.revoke(self.token)
+        self.assertEqual(self.identifier.identify(request), None,
+            'revoked token identified')
+
+    def test_revoke_unknown(self):
+        """Verify revoke evicts a token cached as unknown."""
+        token = 'n3w-t0k3n'
+        request = self.request('Bearer %s' % token)
+        self.identifier.identify(request)
+        self.database.views['pyramid/token_hashes'][hash_token(token)] = \
+            ['robot']
+        self.identifier.revoke(token)
+        self.assertEqual(self.identifier.identify(request), 'robot',
+            'issued token rejected')
+
+    def test_changed(self):
+        """Verify changes to token documents evict their tokens."""
+        request = self.request('Bearer %s' % self.token)
+        self.identifier.identify(request)
+        self.identifier.identify(self.request('Bearer forged'))
+        responses = [{'results': [{'seq': 2, 'id': hash_token(self.token)}],
+            'last_seq': 2}]
+        self.identifier.changes._changes = lambda since: responses.pop(0)
+        self.identifier.changes.since = 1
+        del self.database.views['pyramid/token_hashes'][hash_token(self.token)]
+        self.assertTrue(self.identifier.changes.poll(), 'changes ignored')
+        self.assertEqual(len(self.identifier.cache), 0, 'token not evicted')
+        self.assertEqual(len(self.identifier.negative_cache), 0,
+            'unknown tokens kept after a change')
+        self.assertEqual(self.identifier.identify(request), None,
+            'revoked token identified')
+
+    def test_remember_forget(self):
+        """Verify remember and forget return no headers."""
+        request = self.request()
+        self.assertEqual(self.identifier.remember(request, 'robot'), [])
+        self.assertEqual(self.identifier.forget(request), [])
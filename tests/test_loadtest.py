@@ -0,0 +1,84 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Smoke test the load test harness.
+"""
+
+import json
+import unittest
+from tests.loadtest import FakeCouchServer, MODES, generate_views, run
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # pragma: no cover
+    from urllib2 import Request, urlopen
+
+try:
+    import couchdbkit
+except ImportError:
+    couchdbkit = None
+
+
+class TestFakeCouchServer(unittest.TestCase):
+
+    """Test the fake CouchDB server over plain HTTP."""
+
+    def setUp(self):
+        """Start a server with a few generated users."""
+        self.server = FakeCouchServer(generate_views(4, 2))
+        self.server.start()
+
+    def tearDown(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path, body=None):
+        """Request a path and decode the JSON response."""
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+        request = Request(self.server.uri + path, data,
+            {'Content-Type': 'application/json'})
+        return json.loads(urlopen(request, timeout=5).read().decode('utf-8'))
+
+    def test_view(self):
+        """Verify view queries by key and of all rows."""
+        result = self.fetch('auth/_design/pyramid/_view/user_groups'
+            '?key=%22user1%22')
+        self.assertEqual([row['value'] for row in result['rows']],
+            ['group1', 'group1'], 'keyed view rows invalid')
+        result = self.fetch('auth/_design/pyramid/_view/user_names')
+        self.assertEqual(result['total_rows'], 4, 'view rows invalid')
+        result = self.fetch('auth/_design/pyramid/_view/perm_groups',
+            {'keys': ['perm0', 'read']})
+        self.assertEqual([row['value'] for row in result['rows']],
+            ['group0'], 'multi-key view rows invalid')
+        self.assertEqual(self.server.queries, 3, 'queries not counted')
+
+    def test_changes(self):
+        """Verify the _changes feed times out with no results."""
+        result = self.fetch('auth/_changes?feed=longpoll&timeout=10')
+        self.assertEqual(result, {'results': [], 'last_seq': 0},
+            '_changes response invalid')
+        self.assertEqual(self.fetch('auth')['update_seq'], 0,
+            'database info invalid')
+
+    def test_bulk_docs(self):
+        """Verify _bulk_docs accepts every document."""
+        result = self.fetch('auth/_bulk_docs',
+            {'docs': [{'type': 'audit'}, {'type': 'audit'}]})
+        self.assertEqual([doc['ok'] for doc in result], [True, True],
+            '_bulk_docs response invalid')
+
+    @unittest.skipIf(couchdbkit is None, 'couchdbkit is not installed')
+    def test_run(self):
+        """Verify every mode serves requests."""
+        from tests.loadtest import make_cookies
+        cookies = make_cookies('loadtest', ['user0', 'user1'])
+        for mode in sorted(MODES):
+            result = run(mode, self.server, cookies, 2, 4)
+            self.assertEqual(result['requests'], 4,
+                'mode %s dropped requests' % mode)
@@ -0,0 +1,81 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the permissions module.
+"""
+
+import unittest
+from pyramid_couchauth.permissions import (PermissionTrie, PermissionTries,
+    covering_grants)
+
+
+class TestPermissionTrie(unittest.TestCase):
+
+    """Test the PermissionTrie class."""
+
+    def test_exact(self):
+        """Verify exact grants only match themselves."""
+        trie = PermissionTrie(['billing.invoice.read', 'view'])
+        self.assertTrue(trie.match('billing.invoice.read'))
+        self.assertTrue(trie.match('view'))
+        self.assertFalse(trie.match('billing.invoice'))
+        self.assertFalse(trie.match('billing.invoice.read.all'))
+        self.assertFalse(trie.match('billing.invoice.write'))
+
+    def test_trailing_wildcard(self):
+        """Verify a trailing wildcard matches any deeper permission."""
+        trie = PermissionTrie(['billing.*'])
+        self.assertTrue(trie.match('billing.invoice'))
+        self.assertTrue(trie.match('billing.invoice.read'))
+        self.assertFalse(trie.match('billing'))
+        self.assertFalse(trie.match('reports.read'))
+
+    def test_inner_wildcard(self):
+        """Verify an inner wildcard matches exactly one segment."""
+        trie = PermissionTrie(['billing.*.read'])
+        self.assertTrue(trie.match('billing.invoice.read'))
+        self.assertTrue(trie.match('billing.account.read'))
+        self.assertFalse(trie.match('billing.invoice.write'))
+        self.assertFalse(trie.match('billing.invoice.line.read'))
+
+    def test_backtrack(self):
+        """Verify a failed literal branch falls back to a wildcard branch."""
+        trie = PermissionTrie(['billing.invoice.write', 'billing.*.read'])
+        self.assertTrue(trie.match('billing.invoice.read'))
+
+    def test_everything(self):
+        """Verify a lone wildcard matches every permission."""
+        trie = PermissionTrie(['*'])
+        self.assertTrue(trie.match('view'))
+        self.assertTrue(trie.match('billing.invoice.read'))
+
+    def test_empty(self):
+        """Verify an empty trie matches nothing."""
+        self.assertFalse(PermissionTrie().match('view'))
+
+
+class TestPermissionTries(unittest.TestCase):
+
+    """Test the PermissionTries class."""
+
+    def test_match(self):
+        """Verify a permission matches if any trie grants it."""
+        tries = PermissionTries([PermissionTrie(['billing.*']),
+            PermissionTrie(['reports.read'])])
+        self.assertTrue(tries.match('billing.invoice.read'))
+        self.assertTrue(tries.match('reports.read'))
+        self.assertFalse(tries.match('reports.write'))
+        self.assertFalse(PermissionTries().match('view'))
+
+
+class TestCoveringGrants(unittest.TestCase):
+
+    """Test the covering_grants function."""
+
+    def test_covering_grants(self):
+        """Verify the covering grants of a permission."""
+        self.assertEqual(covering_grants('billing.invoice.read'),
+            ['billing.invoice.read', 'billing.invoice.*', 'billing.*', '*'])
+        self.assertEqual(covering_grants('view'), ['view', '*'])
@@ -8,12 +8,17 @@ Test Couch auth/auth policies.
 
 import re
 import unittest
+from pyramid import testing
 from pyramid.testing import DummyRequest
 from pyramid.security import Authenticated, Everyone
+from pyramid_couchauth.audit import AuditLog
+from pyramid_couchauth.bloom import UserNameFilter
+from pyramid_couchauth.cache import TTLCache
 from pyramid_couchauth.principal import Principal
 from pyramid_couchauth.identification import AuthTktIdentifier
 from pyramid_couchauth.policies import (CouchAuthenticationPolicy,
-    CouchAuthorizationPolicy)
+    CouchAuthorizationPolicy, LazyPrincipals)
+from pyramid_couchauth.tweens import AuthTimings, TIMINGS_KEY
 from tests.couch import DummyDatabase
 
 
@@ -73,13 +78,6 @@ class TestCouchAuthenticationPolicy(TestPolicy):
         self.assertEqual(self.policy.user_groups_view, 'pyramid/user_groups',
             'user_groups_view not set to default value')
 
-    def test_expand_principal(self):
-        """Test the _expand_principal method."""
-        expected = set([Authenticated, 'user:admin', 'group:administrators'])
-        principals = set(self.policy._expand_principal('admin'))
-        self.assertEqual(principals, expected,
-            'expanded principals invalid')
-
     def test_unauthenticated_userid(self):
         """Test the unauthenticated_userid method."""
         self.assertEqual(self.policy.unauthenticated_userid(self.request),
@@ -125,6 +123,106 @@ class TestCouchAuthenticationPolicy(TestPolicy):
             self.assertTrue(header_value.match(header[1]),
                 'forget header value invalid')
 
+    def test_cache(self):
+        """Test user lookups are served from the cache."""
+        policy = CouchAuthenticationPolicy(self.database, self.identifier,
+            cache=TTLCache())
+        expected = set([Authenticated, Everyone, 'user:admin', 'group:administrators'])
+        self.assertEqual(set(policy.effective_principals(self.request)),
+            expected, 'effective principals invalid')
+        queries = self.database.queries
+        self.assertEqual(set(policy.effective_principals(self.request)),
+            expected, 'cached effective principals invalid')
+        self.assertEqual(policy.authenticated_userid(self.request),
+            self.username, 'cached authenticated userid invalid')
+        self.assertEqual(self.database.queries, queries,
+            'cached lookups queried the database')
+
+    def test_effective_principals_timed(self):
+        """Test the effective_principals method records its duration."""
+        self.request.environ[TIMINGS_KEY] = AuthTimings()
+        list(self.policy.effective_principals(self.request))
+        durations = self.request.environ[TIMINGS_KEY].durations
+        self.assertEqual(set(durations), set(['identify', 'expand']),
+            'effective principals not timed')
+
+    def test_effective_principals_lazy(self):
+        """Test the effective_principals method expands on iteration."""
+        principals = self.policy.effective_principals(self.request)
+        self.assertEqual(self.database.queries, 0,
+            'effective principals queried before iteration')
+        iterator = iter(principals)
+        self.assertEqual(next(iterator), Everyone, 'first principal invalid')
+        self.assertEqual(self.database.queries, 0,
+            'Everyone required a query')
+        self.assertEqual(next(iterator), Authenticated,
+            'second principal invalid')
+        self.assertEqual(next(iterator), 'user:admin',
+            'third principal invalid')
+        self.assertEqual(self.database.queries, 1,
+            'user principal required a group query')
+        self.assertEqual(list(iterator), ['group:administrators'],
+            'group principals invalid')
+        self.assertEqual(self.database.queries, 2,
+            'group principals not queried')
+        self.assertEqual(len(principals), 4, 'principal count invalid')
+        self.assertEqual(self.database.queries, 2,
+            'expanded principals queried twice')
+
+    def test_effective_principals_unknown(self):
+        """Test the effective_principals method for an unknown user."""
+        headers = self.identifier.remember(self.request, 'nobody')
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        self.request.cookies = {'auth_tkt': cookie}
+        principals = self.policy.effective_principals(self.request)
+        self.assertEqual(list(principals), [Everyone],
+            'unknown user principals invalid')
+        self.assertTrue('user:nobody' not in principals,
+            'unknown user is effective')
+        self.assertEqual(self.database.queries, 1,
+            'unknown user groups queried')
+
+    def test_user_filter(self):
+        """Test unknown users are rejected by the user filter."""
+        user_filter = UserNameFilter(self.database)
+        user_filter.rebuild()
+        queries = self.database.queries
+        policy = CouchAuthenticationPolicy(self.database, self.identifier,
+            user_filter=user_filter)
+        headers = self.identifier.remember(self.request, 'nobody')
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        self.request.cookies = {'auth_tkt': cookie}
+        self.assertTrue(policy.authenticated_userid(self.request) is None,
+            'unknown user authenticated')
+        self.assertEqual(self.database.queries, queries,
+            'unknown user queried the database')
+
+    def test_user_filter_remember(self):
+        """Test users remembered after a rebuild pass the user filter."""
+        user_filter = UserNameFilter(self.database)
+        user_filter.rebuild()
+        self.database.views['pyramid/user_names']['newbie'] = ['newbie']
+        policy = CouchAuthenticationPolicy(self.database, self.identifier,
+            user_filter=user_filter)
+        headers = policy.remember(self.request, 'newbie')
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        self.request.cookies = {'auth_tkt': cookie}
+        self.assertEqual(policy.authenticated_userid(self.request), 'newbie',
+            'remembered user rejected')
+
+    def test_audit(self):
+        """Test remember and forget are audited."""
+        audit = AuditLog(self.database)
+        policy = CouchAuthenticationPolicy(self.database, self.identifier,
+            audit=audit)
+        policy.remember(self.request, self.username)
+        policy.forget(self.request)
+        audit.flush()
+        events = [(doc['event'], doc.get('principal'), doc.get('userid'),
+            doc.get('claimed_userid')) for doc in self.database.docs]
+        self.assertEqual(events, [('remember', 'user:admin', 'admin', None),
+            ('forget', None, None, 'admin')], 'audit records invalid')
+
 
 class TestCouchAuthorizationPolicy(TestPolicy):
 
@@ -180,3 +278,247 @@ class TestCouchAuthorizationPolicy(TestPolicy):
         self.assertEqual(expect, found,
             'invalid principals for godmode permission')
 
+    def test_permits_timed(self):
+        """Test the permits method records its duration."""
+        request = DummyRequest()
+        request.environ[TIMINGS_KEY] = AuthTimings()
+        testing.setUp(request=request)
+        try:
+            self.policy.permits(self.context, ['group:administrators'],
+                'superpowers')
+        finally:
+            testing.tearDown()
+        self.assertTrue('permits' in request.environ[TIMINGS_KEY].durations,
+            'permits not timed')
+
+    def test_permits_timed_expand(self):
+        """Test expansion during permits is timed once, as expand."""
+        now = [0]
+        view = self.database.view
+
+        def slow_view(name, key=None):
+            now[0] += 1
+            return view(name, key)
+        self.database.view = slow_view
+        authentication = CouchAuthenticationPolicy(self.database,
+            AuthTktIdentifier('secret'))
+        request = DummyRequest()
+        timings = AuthTimings(clock=lambda: now[0])
+        request.environ[TIMINGS_KEY] = timings
+        testing.setUp(request=request)
+        try:
+            self.assertTrue(self.policy.permits(self.context,
+                LazyPrincipals(authentication, request, 'admin'),
+                'superpowers'))
+        finally:
+            testing.tearDown()
+        self.assertEqual(timings.durations, {'permits': 1, 'expand': 2},
+            'expansion counted under permits')
+        self.assertEqual(timings.total(), 3, 'total invalid')
+
+    def test_permits_user_short_circuit(self):
+        """Test the permits method stops before groups on a user grant."""
+        self.database.add_view('pyramid/user_perms', {
+            'admin': ['superpowers']})
+        policy = CouchAuthorizationPolicy(self.database,
+            user_perms_view='pyramid/user_perms')
+        identifier = AuthTktIdentifier('secret')
+        authentication = CouchAuthenticationPolicy(self.database, identifier)
+        request = DummyRequest()
+        headers = identifier.remember(request, 'admin')
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        request.cookies = {'auth_tkt': cookie}
+        principals = authentication.effective_principals(request)
+        self.assertTrue(policy.permits(self.context, principals,
+            'superpowers'), 'admin does not have superpowers')
+        self.assertEqual(principals.principals,
+            [Everyone, Authenticated, 'user:admin'],
+            'groups expanded after a user grant')
+
+    def test_permits_hierarchical(self):
+        """Test the permits method with hierarchical permissions."""
+        self.database.add_view('pyramid/group_perms', {
+            'administrators': ['billing.*', 'reports.*.read']})
+        policy = CouchAuthorizationPolicy(self.database, hierarchical=True)
+        principals = ['group:administrators']
+        self.assertTrue(policy.permits(self.context, principals,
+            'billing.invoice.read'), 'wildcard grant denied')
+        self.assertTrue(policy.permits(self.context, principals,
+            'reports.sales.read'), 'inner wildcard grant denied')
+        self.assertFalse(policy.permits(self.context, principals,
+            'reports.sales.write'), 'ungranted permission allowed')
+        queries = self.database.queries
+        policy.permits(self.context, principals, 'billing.account.write')
+        self.assertEqual(self.database.queries, queries,
+            'compiled grants not cached')
+
+    def test_permits_hierarchical_invalidate(self):
+        """Test compiled grants are reloaded from the database."""
+        grants = {'administrators': ['billing.*']}
+        self.database.add_view('pyramid/group_perms', grants)
+        policy = CouchAuthorizationPolicy(self.database, hierarchical=True,
+            cache=TTLCache())
+        principals = ['group:administrators']
+        policy._grants('pyramid/group_perms', 'administrators')
+        grants['administrators'] = ['reports.*']
+        self.assertTrue(policy.permits(self.context, principals,
+            'reports.sales.read'), 'trie compiled from cached grants')
+        grants['administrators'] = ['billing.*']
+        policy.invalidate('group:administrators')
+        self.assertTrue(policy.permits(self.context, principals,
+            'billing.invoice.read'), 'trie not invalidated')
+
+    def test_principals_allowed_by_permission_hierarchical(self):
+        """Test principals_allowed_by_permission with wildcard grants."""
+        self.database.add_view('pyramid/perm_groups', {
+            'billing.*': ['administrators'],
+            'billing.invoice.read': ['accountants', 'administrators']})
+        policy = CouchAuthorizationPolicy(self.database, hierarchical=True)
+        queries = self.database.queries
+        found = policy.principals_allowed_by_permission(self.context,
+            'billing.invoice.read')
+        self.assertEqual(found, ['group:accountants', 'group:administrators'],
+            'invalid principals for hierarchical permission')
+        self.assertEqual(self.database.queries, queries + 1,
+            'covering grants not fetched in one query')
+
+    def test_permits_audit(self):
+        """Test the permits method audits the principals it checked."""
+        audit = AuditLog(self.database)
+        policy = CouchAuthorizationPolicy(self.database, audit=audit)
+        principals = [Everyone, 'group:administrators', 'group:others']
+        policy.permits(self.context, principals, 'superpowers')
+        policy.permits(self.context, principals, 'godmode')
+        audit.flush()
+        docs = self.database.docs
+        self.assertEqual([doc['allowed'] for doc in docs], [True, False],
+            'audited decisions invalid')
+        self.assertEqual(docs[0]['principals'],
+            [Everyone, 'group:administrators'],
+            'audited principals invalid for allowed decision')
+        self.assertEqual(docs[1]['principals'], principals,
+            'audited principals invalid for denied decision')
+
+    def test_permits_audit_context(self):
+        """Test the permits method audits the user, context and path."""
+        audit = AuditLog(self.database)
+        policy = CouchAuthorizationPolicy(self.database, audit=audit)
+        root = testing.DummyResource()
+        root['reports'] = testing.DummyResource()
+        testing.setUp(request=DummyRequest(path='/reports/view'))
+        try:
+            policy.permits(root['reports'],
+                [Everyone, Authenticated, 'user:admin'], 'view')
+            policy.permits(None, [Everyone], 'view')
+        finally:
+            testing.tearDown()
+        policy.permits(self.context, [Everyone], 'view')
+        audit.flush()
+        records = [(doc['userid'], doc['context'], doc['path'])
+            for doc in self.database.docs]
+        self.assertEqual(records, [('admin', '/reports', '/reports/view'),
+            (None, None, '/reports/view'),
+            (None, '%s.dict' % dict.__module__, None)],
+            'audited user, context or path invalid')
+
+    def test_permits_audit_claimed(self):
+        """Test unverified usernames are not audited as the user."""
+        audit = AuditLog(self.database)
+        policy = CouchAuthorizationPolicy(self.database, audit=audit)
+        authentication = CouchAuthenticationPolicy(self.database,
+            AuthTktIdentifier('secret'))
+        request = DummyRequest()
+        policy.permits(self.context,
+            LazyPrincipals(authentication, request, 'mallory'), 'superpowers')
+        policy.permits(self.context,
+            LazyPrincipals(authentication, request, 'admin'), 'superpowers')
+        audit.flush()
+        records = [(doc['userid'], doc['claimed_userid'], doc['principals'])
+            for doc in self.database.docs]
+        self.assertEqual(records, [(None, 'mallory', [Everyone]),
+            ('admin', None, [Everyone, Authenticated, 'user:admin',
+            'group:administrators'])], 'unverified user audited as the user')
+
+    def test_permits_decision_cache(self):
+        """Test the permits method caches decisions by principal set."""
+        policy = CouchAuthorizationPolicy(self.database,
+            decision_cache=TTLCache())
+        self.assertTrue(policy.permits(self.context,
+            [Everyone, 'group:administrators'], 'superpowers'))
+        queries = self.database.queries
+        self.assertTrue(policy.permits(self.context,
+            ['group:administrators', Everyone], 'superpowers'),
+            'cached decision invalid')
+        self.assertEqual(self.database.queries, queries,
+            'cached decision queried the database')
+
+    def test_permits_decision_cache_user(self):
+        """Test cached decisions for lazy principals need no queries."""
+        authentication = CouchAuthenticationPolicy(self.database,
+            AuthTktIdentifier('secret'))
+        principals = lambda: LazyPrincipals(authentication, DummyRequest(),
+            'admin')
+        policy = CouchAuthorizationPolicy(self.database,
+            decision_cache=TTLCache())
+        self.assertTrue(policy.permits(self.context, principals(),
+            'superpowers'))
+        queries = self.database.queries
+        self.assertTrue(policy.permits(self.context, principals(),
+            'superpowers'), 'cached decision invalid')
+        self.assertEqual(self.database.queries, queries,
+            'cached decision queried the database')
+        policy.invalidate('user:other')
+        self.assertEqual(len(policy.decision_cache), 1,
+            'decision of another user invalidated')
+        policy.invalidate('user:admin')
+        self.assertEqual(len(policy.decision_cache), 0,
+            'decision kept after user invalidate')
+        policy.permits(self.context, principals(), 'superpowers')
+        policy.invalidate('group:others')
+        self.assertEqual(len(policy.decision_cache), 0,
+            'decision kept after group invalidate')
+
+    def test_invalidate_groups(self):
+        """Test invalidate revokes access after a group membership change."""
+        cache = TTLCache()
+        authentication = CouchAuthenticationPolicy(self.database,
+            AuthTktIdentifier('secret'), cache=cache)
+        policy = CouchAuthorizationPolicy(self.database, cache=cache,
+            decision_cache=TTLCache(), authentication=authentication)
+        principals = lambda: LazyPrincipals(authentication, DummyRequest(),
+            'admin')
+        self.assertTrue(policy.permits(self.context, principals(),
+            'superpowers'))
+        self.database.views['pyramid/user_groups']['admin'] = []
+        policy.invalidate('user:admin')
+        self.assertFalse(policy.permits(self.context, principals(),
+            'superpowers'), 'stale groups used after invalidate')
+        self.database.views['pyramid/user_groups']['admin'] = [
+            'administrators']
+        policy.invalidate('group:administrators')
+        self.assertTrue(policy.permits(self.context, principals(),
+            'superpowers'), 'stale groups used after group invalidate')
+        del self.database.views['pyramid/user_names']['admin']
+        policy.invalidate()
+        self.assertFalse(policy.permits(self.context, principals(),
+            'superpowers'), 'removed user kept after full invalidate')
+
+    def test_invalidate(self):
+        """Test invalidate forgets grants and decisions of a principal."""
+        policy = CouchAuthorizationPolicy(self.database, cache=TTLCache(),
+            decision_cache=TTLCache())
+        admins = ['group:administrators']
+        others = ['group:others']
+        self.assertTrue(policy.permits(self.context, admins, 'superpowers'))
+        self.assertFalse(policy.permits(self.context, others, 'superpowers'))
+        self.database.add_view('pyramid/group_perms', {})
+        policy.invalidate('group:administrators')
+        self.assertFalse(policy.permits(self.context, admins, 'superpowers'),
+            'stale grant used after invalidate')
+        self.assertEqual(len(policy.decision_cache), 2,
+            'unrelated decisions invalidated')
+        policy.invalidate()
+        self.assertEqual(len(policy.decision_cache), 0,
+            'decisions kept after full invalidate')
+        self.assertEqual(len(policy.cache), 0,
+            'grants kept after full invalidate')
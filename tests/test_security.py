@@ -0,0 +1,161 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test the Pyramid 2.x security policy.
+"""
+
+import re
+import unittest
+from pyramid.interfaces import ISecurityPolicy
+from pyramid.security import Authenticated, Everyone
+from pyramid.testing import DummyRequest
+from pyramid_couchauth.audit import AuditLog
+from pyramid_couchauth.identification import AuthTktIdentifier
+from pyramid_couchauth.permissions import PermissionTrie, PermissionTries
+from pyramid_couchauth.policies import (CouchAuthenticationPolicy,
+    CouchAuthorizationPolicy)
+from pyramid_couchauth.security import CouchIdentity, CouchSecurityPolicy
+from tests.couch import DummyDatabase
+
+
+class TestCouchIdentity(unittest.TestCase):
+
+    """Test the CouchIdentity class."""
+
+    def test_allows(self):
+        """Verify prefetched permissions are checked."""
+        identity = CouchIdentity('admin', frozenset(), frozenset(['view']))
+        self.assertTrue(identity.allows('view'))
+        self.assertFalse(identity.allows('edit'))
+
+    def test_allows_hierarchical(self):
+        """Verify prefetched hierarchical permissions are checked."""
+        identity = CouchIdentity('admin', frozenset(),
+            PermissionTries([PermissionTrie(['billing.*'])]))
+        self.assertTrue(identity.allows('billing.invoice.read'))
+        self.assertFalse(identity.allows('reports.read'))
+
+
+class TestCouchSecurityPolicy(unittest.TestCase):
+
+    """Test the CouchSecurityPolicy class."""
+
+    def setUp(self):
+        """Set up the policies and a request for a remembered user."""
+        self.database = DummyDatabase({})
+        self.database.add_view('pyramid/user_names', {
+            'admin': ['admin']})
+        self.database.add_view('pyramid/user_groups', {
+            'admin': ['administrators']})
+        self.database.add_view('pyramid/group_perms', {
+            'administrators': ['superpowers']})
+
+        self.identifier = AuthTktIdentifier('secret')
+        self.authentication = CouchAuthenticationPolicy(self.database,
+            self.identifier)
+        self.authorization = CouchAuthorizationPolicy(self.database)
+        self.policy = CouchSecurityPolicy(self.authentication,
+            self.authorization)
+        self.request = self.make_request('admin')
+
+    def make_request(self, username):
+        """Create a request with a remembered user."""
+        request = DummyRequest()
+        headers = self.identifier.remember(request, username)
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        request.cookies = {'auth_tkt': cookie}
+        return request
+
+    def test_interface(self):
+        """Verify CouchSecurityPolicy implements the security policy."""
+        self.assertTrue(ISecurityPolicy.implementedBy(CouchSecurityPolicy))
+
+    def test_identity(self):
+        """Verify the identity is resolved once per request."""
+        identity = self.policy.identity(self.request)
+        self.assertEqual(identity.userid, 'admin', 'userid invalid')
+        self.assertEqual(identity.principals, frozenset([Everyone,
+            Authenticated, 'user:admin', 'group:administrators']),
+            'principals invalid')
+        self.assertTrue(identity.permissions is None,
+            'permissions prefetched')
+        queries = self.database.queries
+        self.assertTrue(self.policy.identity(self.request) is identity,
+            'identity resolved twice')
+        self.assertEqual(self.policy.authenticated_userid(self.request),
+            'admin', 'authenticated userid invalid')
+        self.assertEqual(self.database.queries, queries,
+            'identity reuse queried the database')
+
+    def test_identity_unknown(self):
+        """Verify unknown users have no identity."""
+        request = self.make_request('nobody')
+        self.assertTrue(self.policy.identity(request) is None,
+            'unknown user identified')
+        self.assertTrue(self.policy.authenticated_userid(request) is None,
+            'unknown user authenticated')
+        self.assertFalse(self.policy.permits(request, None, 'superpowers'),
+            'unknown user permitted')
+
+    def test_permits(self):
+        """Verify permits checks the identity's principals."""
+        self.assertTrue(self.policy.permits(self.request, None,
+            'superpowers'), 'admin does not have superpowers')
+        self.assertFalse(self.policy.permits(self.request, None, 'godmode'),
+            'admin has godmode')
+
+    def test_permits_prefetched(self):
+        """Verify prefetched permissions need no further queries."""
+        policy = CouchSecurityPolicy(self.authentication, self.authorization,
+            prefetch_permissions=True)
+        identity = policy.identity(self.request)
+        self.assertEqual(identity.permissions, frozenset(['superpowers']),
+            'prefetched permissions invalid')
+        queries = self.database.queries
+        self.assertTrue(policy.permits(self.request, None, 'superpowers'))
+        self.assertFalse(policy.permits(self.request, None, 'godmode'))
+        self.assertEqual(self.database.queries, queries,
+            'prefetched permits queried the database')
+
+    def test_permits_prefetched_hierarchical(self):
+        """Verify prefetched hierarchical permissions reuse cached tries."""
+        authorization = CouchAuthorizationPolicy(self.database,
+            hierarchical=True)
+        policy = CouchSecurityPolicy(self.authentication, authorization,
+            prefetch_permissions=True)
+        permissions = policy.identity(self.request).permissions
+        self.assertTrue(permissions.match('superpowers'))
+        trie = authorization.trie_cache.get(('pyramid/group_perms',
+            'administrators'))
+        self.assertTrue(trie in permissions.tries, 'cached trie not reused')
+        permissions = policy.identity(self.make_request('admin')).permissions
+        self.assertTrue(trie in permissions.tries, 'trie compiled again')
+
+    def test_permits_prefetched_audit(self):
+        """Verify checks against prefetched permissions are audited."""
+        audit = AuditLog(self.database)
+        authorization = CouchAuthorizationPolicy(self.database, audit=audit)
+        policy = CouchSecurityPolicy(self.authentication, authorization,
+            prefetch_permissions=True)
+        policy.permits(self.request, None, 'superpowers')
+        policy.permits(self.request, None, 'godmode')
+        audit.flush()
+        records = [(doc['event'], doc['userid'], doc['permission'],
+            doc['allowed']) for doc in self.database.docs]
+        self.assertEqual(records, [('permits', 'admin', 'superpowers', True),
+            ('permits', 'admin', 'godmode', False)],
+            'prefetched decisions not audited')
+        self.assertEqual(self.database.docs[0]['principals'],
+            sorted([Everyone, Authenticated, 'user:admin',
+            'group:administrators']), 'audited principals invalid')
+
+    def test_remember_forget(self):
+        """Verify remember and forget delegate to the identifier."""
+        headers = self.policy.remember(self.request, 'admin')
+        self.assertTrue(headers[0][1].startswith('auth_tkt='),
+            'remember headers invalid')
+        headers = self.policy.forget(self.request)
+        self.assertTrue(headers[0][1].startswith('auth_tkt=;') or
+            headers[0][1].startswith('auth_tkt=""'), 'forget headers invalid')
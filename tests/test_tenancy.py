@@ -0,0 +1,274 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test multi-tenant policies.
+"""
+
+import re
+import sys
+import unittest
+from pyramid import testing
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
+from pyramid.interfaces import ISecurityPolicy
+from pyramid.security import Authenticated, Everyone
+from pyramid_couchauth import configure_tenants
+from pyramid_couchauth.audit import AuditLog
+from pyramid_couchauth.cache import TTLCache
+from pyramid_couchauth.identification import AuthTktIdentifier
+from pyramid_couchauth.policies import (CouchAuthenticationPolicy,
+    CouchAuthorizationPolicy, LazyPrincipals)
+from pyramid_couchauth.security import TenantSecurityPolicy
+from pyramid_couchauth.tenancy import (HostTenantResolver, PathTenantResolver,
+    ServerDatabaseFactory, TenantAuthenticationPolicy,
+    TenantAuthorizationPolicy, TenantIdentifier, TenantRegistry)
+from tests.couch import DummyDatabase
+
+
+class DummyServer:
+
+    """Pretend to be a couchdbkit server holding tenant databases."""
+
+    def __init__(self):
+        """Initialize the server."""
+        self.databases = {}
+
+    def __contains__(self, name):
+        """Return True if a database exists."""
+        return name in self.databases
+
+    def get_db(self, name):
+        """Return a database by name."""
+        return self.databases[name]
+
+    def get_or_create_db(self, name):
+        """Return a database by name, creating it if necessary."""
+        return self.databases.setdefault(name, DummyDatabase({}))
+
+
+class TestResolvers(unittest.TestCase):
+
+    """Test the tenant resolvers."""
+
+    def test_host(self):
+        """Verify tenants are resolved from the host name."""
+        request = testing.DummyRequest()
+        request.host = 'Acme.example.com:8080'
+        self.assertEqual(HostTenantResolver()(request), 'acme.example.com')
+        self.assertEqual(HostTenantResolver('.example.com')(request), 'acme')
+        self.assertEqual(HostTenantResolver('.example.org')(request), None)
+
+    def test_path(self):
+        """Verify tenants are resolved from the path."""
+        request = testing.DummyRequest(path='/acme/items/1')
+        self.assertEqual(PathTenantResolver()(request), 'acme')
+        self.assertEqual(PathTenantResolver(1)(request), 'items')
+        self.assertEqual(PathTenantResolver(3)(request), None)
+
+
+class TestTenantPolicies(unittest.TestCase):
+
+    """Test the tenant registry and policies."""
+
+    def setUp(self):
+        """Set up two tenants with different users."""
+        self.server = DummyServer()
+        for tenant, user in (('acme', 'alice'), ('globex', 'bob')):
+            database = DummyDatabase({})
+            database.add_view('pyramid/user_names', {user: [user]})
+            database.add_view('pyramid/user_groups', {user: ['staff']})
+            database.add_view('pyramid/group_perms', {'staff': ['view']})
+            self.server.databases['tenant_' + tenant] = database
+
+        self.identifier = AuthTktIdentifier('secret')
+        self.audit = AuditLog(DummyDatabase({}))
+        self.registry = TenantRegistry(PathTenantResolver(),
+            ServerDatabaseFactory(self.server, 'tenant_%s'),
+            self.policy_factory, max_tenants=1)
+        self.authentication = TenantAuthenticationPolicy(self.registry)
+        self.authorization = TenantAuthorizationPolicy(self.registry)
+
+    def tearDown(self):
+        """Clean up the threadlocal request."""
+        testing.tearDown()
+
+    def policy_factory(self, tenant, database):
+        """Create the policies of a tenant sharing one lookup cache."""
+        cache = TTLCache(16)
+        audit = self.audit.bind(tenant=tenant)
+        authentication = CouchAuthenticationPolicy(database,
+            TenantIdentifier(self.identifier, tenant), cache=cache,
+            audit=audit)
+        authorization = CouchAuthorizationPolicy(database, cache=cache)
+        return authentication, authorization
+
+    def request(self, tenant, username):
+        """Create a request for a tenant with a remembered user."""
+        request = testing.DummyRequest(path='/%s/' % tenant)
+        headers = self.authentication.remember(request, username)
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        request.cookies = {'auth_tkt': cookie}
+        return request
+
+    def test_authenticated_userid(self):
+        """Verify users are looked up in their tenant's database."""
+        self.assertEqual(self.authentication.authenticated_userid(
+            self.request('acme', 'alice')), 'alice')
+        self.assertEqual(self.authentication.authenticated_userid(
+            self.request('globex', 'alice')), None)
+
+    def test_cross_tenant_cookie(self):
+        """Verify a user remembered in one tenant is unknown in another."""
+        self.server.databases['tenant_globex'].add_view('pyramid/user_names',
+            {'alice': ['alice']})
+        request = self.request('acme', 'alice')
+        request.path_info = '/globex/'
+        self.assertEqual(self.authentication.unauthenticated_userid(request),
+            None, 'identity accepted by another tenant')
+        self.assertEqual(self.authentication.authenticated_userid(request),
+            None, 'user authenticated by another tenant')
+        forged = testing.DummyRequest(path='/globex/')
+        headers = self.identifier.remember(forged, 'alice')
+        cookie = re.sub(';.*', '', headers[0][1][len(headers[0][0])-1:]).strip('"')
+        forged.cookies = {'auth_tkt': cookie}
+        self.assertEqual(self.authentication.unauthenticated_userid(forged),
+            None, 'identity without a tenant accepted')
+
+    def test_no_tenant(self):
+        """Verify requests without a tenant are unauthenticated."""
+        request = testing.DummyRequest(path='/')
+        self.assertEqual(self.authentication.authenticated_userid(request),
+            None)
+        principals = self.authentication.effective_principals(request)
+        self.assertTrue(isinstance(principals, LazyPrincipals),
+            'principals type inconsistent')
+        self.assertEqual(list(principals), [Everyone])
+        testing.setUp(request=request)
+        self.assertFalse(self.authorization.permits(None, [Everyone], 'view'))
+
+    def test_permits(self):
+        """Verify permissions are checked in the request's tenant."""
+        request = self.request('globex', 'bob')
+        testing.setUp(request=request)
+        principals = self.authentication.effective_principals(request)
+        self.assertEqual(set(principals),
+            set([Everyone, Authenticated, 'user:bob', 'group:staff']))
+        self.assertTrue(self.authorization.permits(None, principals, 'view'))
+
+    def test_evict(self):
+        """Verify tenants beyond max_tenants are evicted with their caches."""
+        acme = self.request('acme', 'alice')
+        first = self.registry.policies(acme)
+        self.registry.policies(self.request('globex', 'bob'))
+        self.assertEqual(len(self.registry.tenants), 1,
+            'tenant count not bounded')
+        self.assertFalse(self.registry.policies(acme) is first,
+            'evicted tenant reused')
+
+    def test_invalid_tenant(self):
+        """Verify invalid tenant names never reach the server."""
+        self.server.databases['tenant__users'] = DummyDatabase({})
+        for path in ('/_users/', '/favicon.ico', '/Acme/'):
+            request = testing.DummyRequest(path=path)
+            self.assertEqual(self.registry.policies(request), (None, None),
+                'invalid tenant %s accepted' % path)
+        self.assertEqual(len(self.registry.unknown), 0,
+            'invalid tenant looked up')
+
+    def test_allowed(self):
+        """Verify only allowed tenants get policies."""
+        self.registry.allowed = set(['acme'])
+        self.assertEqual(self.registry.policies(
+            testing.DummyRequest(path='/globex/')), (None, None),
+            'tenant outside the allowed set accepted')
+        self.assertTrue(self.registry.policies(
+            self.request('acme', 'alice'))[0] is not None,
+            'allowed tenant refused')
+
+    def test_unknown_tenant(self):
+        """Verify unknown tenants get no policies and evict no tenants."""
+        acme = self.request('acme', 'alice')
+        first = self.registry.policies(acme)
+        request = testing.DummyRequest(path='/static/')
+        self.assertEqual(self.registry.policies(request), (None, None),
+            'unknown tenant has policies')
+        self.assertEqual(self.authentication.authenticated_userid(request),
+            None, 'user authenticated by an unknown tenant')
+        self.assertTrue(self.registry.policies(acme) is first,
+            'tenant evicted by an unknown tenant')
+        self.assertTrue('static' in self.registry.unknown,
+            'unknown tenant not remembered')
+
+    def test_audit(self):
+        """Verify audit records of a tenant carry its name."""
+        self.request('acme', 'alice')
+        self.audit.flush()
+        self.assertEqual([(doc['event'], doc['tenant'])
+            for doc in self.audit.database.docs], [('remember', 'acme')],
+            'tenant not recorded')
+
+    def test_security_policy(self):
+        """Verify the security policy uses the request's tenant."""
+        policy = TenantSecurityPolicy(self.registry)
+        self.assertTrue(ISecurityPolicy.providedBy(policy))
+        request = self.request('globex', 'bob')
+        self.assertEqual(policy.authenticated_userid(request), 'bob')
+        self.assertTrue(policy.permits(request, None, 'view'))
+        request = self.request('acme', 'alice')
+        request.path_info = '/globex/'
+        self.assertEqual(policy.authenticated_userid(request), None,
+            'user authenticated by another tenant')
+        request = testing.DummyRequest(path='/_users/')
+        self.assertFalse(policy.permits(request, None, 'view'))
+        self.assertEqual(policy.remember(request, 'bob'), [])
+
+
+class TestConfigureTenants(unittest.TestCase):
+
+    """Test the configure_tenants function."""
+
+    def setUp(self):
+        """Set up a server with one tenant."""
+        self.server = DummyServer()
+        self.server.databases['acme'] = DummyDatabase({})
+
+    def test_security_policy(self):
+        """Verify the tenant security policy is registered."""
+        config = Configurator(settings={'couchauth.security_policy': 'true',
+            'couchauth.cache_size': '16', 'couchauth.audit': 'true'})
+        configure_tenants(config, self.server, PathTenantResolver())
+        config.commit()
+        policy = config.registry.queryUtility(ISecurityPolicy)
+        self.assertTrue(isinstance(policy, TenantSecurityPolicy),
+            'security policy not registered')
+        request = testing.DummyRequest(path='/acme/')
+        authentication, authorization = policy.registry.policies(request)
+        self.assertTrue(isinstance(authentication.identifier,
+            TenantIdentifier), 'identifier not bound to the tenant')
+        self.assertTrue(authentication.cache is authorization.cache,
+            'tenant cache not shared')
+        self.assertEqual(authentication.audit.fields, {'tenant': 'acme'},
+            'audit log not bound to the tenant')
+        self.assertTrue('couchauth_audit' in self.server.databases,
+            'audit database not created')
+        authentication.audit.audit.stop()
+
+    def test_security_policy_unavailable(self):
+        """Verify the security policy is refused without Pyramid 2.x."""
+        config = Configurator(settings={'couchauth.security_policy': 'true'})
+        security = sys.modules['pyramid_couchauth.security']
+        sys.modules['pyramid_couchauth.security'] = None
+        try:
+            self.assertRaises(ConfigurationError, configure_tenants, config,
+                self.server, PathTenantResolver())
+        finally:
+            sys.modules['pyramid_couchauth.security'] = security
+
+    def test_background_threads(self):
+        """Verify settings starting per tenant threads are refused."""
+        for name in ('couchauth.refresh_ahead', 'couchauth.user_filter'):
+            config = Configurator(settings={name: 'true'})
+            self.assertRaises(ConfigurationError, configure_tenants, config,
+                self.server, PathTenantResolver())
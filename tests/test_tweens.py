@@ -0,0 +1,124 @@
+# Copyright (c) 2011-2012 Ryan Bourgeois <bluedragonx@gmail.com>
+#
+# This project is free software according to the BSD-modified license. Refer to
+# the LICENSE file for complete details.
+"""
+Test couchauth tweens.
+"""
+
+import logging
+import re
+import unittest
+from pyramid import testing
+from pyramid.response import Response
+from pyramid_couchauth.tweens import (AuthTimings, TIMINGS_KEY, timed,
+    timing_tween_factory)
+
+
+class TestAuthTimings(unittest.TestCase):
+
+    """Test the AuthTimings class."""
+
+    def test_add(self):
+        """Verify durations accumulate per step."""
+        timings = AuthTimings()
+        timings.add('identify', 0.001)
+        timings.add('permits', 0.002)
+        timings.add('permits', 0.003)
+        self.assertEqual(len(timings), 2, 'step count invalid')
+        self.assertAlmostEqual(timings.total(), 0.006)
+
+    def test_header(self):
+        """Verify the Server-Timing header value."""
+        timings = AuthTimings()
+        timings.add('identify', 0.001)
+        timings.add('permits', 0.0025)
+        self.assertEqual(timings.header(),
+            'couchauth-identify;dur=1.000, couchauth-permits;dur=2.500',
+            'header value invalid')
+
+
+class TestTimed(unittest.TestCase):
+
+    """Test the timed context manager."""
+
+    def test_untimed(self):
+        """Verify requests which are not timed are left alone."""
+        request = testing.DummyRequest()
+        with timed(request, 'identify'):
+            pass
+        with timed(None, 'identify'):
+            pass
+        self.assertFalse(TIMINGS_KEY in request.environ,
+            'untimed request was timed')
+
+    def test_timed(self):
+        """Verify the block is timed."""
+        request = testing.DummyRequest()
+        request.environ[TIMINGS_KEY] = AuthTimings()
+        with timed(request, 'identify'):
+            pass
+        self.assertTrue('identify' in request.environ[TIMINGS_KEY].durations,
+            'block not timed')
+
+    def test_nested(self):
+        """Verify nested steps are not counted by their enclosing step."""
+        times = [0, 1, 4, 6]
+        timings = AuthTimings(clock=lambda: times.pop(0))
+        request = testing.DummyRequest()
+        request.environ[TIMINGS_KEY] = timings
+        with timed(request, 'permits'):
+            with timed(request, 'expand'):
+                pass
+        self.assertEqual(timings.durations, {'permits': 3, 'expand': 3},
+            'nested step counted twice')
+        self.assertEqual(timings.total(), 6, 'total invalid')
+
+
+class TestTimingTween(unittest.TestCase):
+
+    """Test the timing tween."""
+
+    def setUp(self):
+        """Set up the Pyramid testing registry."""
+        self.config = testing.setUp(settings={
+            'couchauth.slow_threshold': '0'})
+
+    def tearDown(self):
+        """Tear down the Pyramid testing registry."""
+        testing.tearDown()
+
+    def handler(self, request):
+        """A handler which performs an auth step."""
+        with timed(request, 'permits'):
+            pass
+        return Response()
+
+    def test_header(self):
+        """Verify the tween adds the Server-Timing header."""
+        tween = timing_tween_factory(self.handler, self.config.registry)
+        response = tween(testing.DummyRequest())
+        self.assertTrue(re.match(r'^couchauth-permits;dur=[0-9.]+$',
+            response.headers['Server-Timing']), 'header value invalid')
+
+    def test_no_steps(self):
+        """Verify no header is added when no auth steps ran."""
+        tween = timing_tween_factory(lambda request: Response(),
+            self.config.registry)
+        response = tween(testing.DummyRequest())
+        self.assertFalse('Server-Timing' in response.headers,
+            'header added without timings')
+
+    def test_slow(self):
+        """Verify slow requests are logged."""
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('pyramid_couchauth.tweens')
+        logger.addHandler(handler)
+        try:
+            tween = timing_tween_factory(self.handler, self.config.registry)
+            tween(testing.DummyRequest())
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(records), 1, 'slow request not logged')